@@ -0,0 +1,201 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+from time import perf_counter
+
+from ex1 import URL, HTMLParser
+from ex2 import style_layout, stylesheet_links, fetch_rules, paint_display_list, use_headless_fonts, WIDTH
+
+'''
+Render many pages without a window, spread over a process pool
+- Each page goes load -> parse -> css (linked stylesheets) -> style -> layout -> paint in one worker
+- One JSON line per page is written as soon as it is done
+- Works offline with file:// pages (and their linked stylesheets), test, and data: urls
+
+Input files have one page per line, blank lines and # comments are skipped
+- a bare url, e.g. file:///srv/archive/index.html
+- or a JSON object {"url": ..., "id": ..., "width": ...}, id and width optional
+'''
+
+STAGES = ["load", "parse", "css", "style", "layout", "paint"]
+
+# Jobs from the lines of an input file, id defaults to the position in the whole batch
+def read_jobs(lines, width, start=0):
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"): continue
+        job = json.loads(line) if line.startswith("{") else {"url": line}
+        job.setdefault("id", start + len(jobs))
+        job.setdefault("width", width)
+        jobs.append(job)
+    return jobs
+
+# Runs in every worker
+def init_worker():
+    use_headless_fonts()
+    # URL and friends print their errors, keep stdout for the JSON lines
+    sys.stdout = sys.stderr
+
+# Inline runs keep stdout, only the fonts have to be switched
+def init_worker_fonts_only():
+    use_headless_fonts()
+
+def digest(display_list):
+    data = json.dumps(display_list, separators=(",", ":"))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+'''
+Render one job, never raises
+Return {"id", "url", "ok", "ms": {stage: ms}, "total_ms", ...}
+plus commands/height/digest (and display_list when full) if ok, error if not
+'''
+def render_page(job, full=False):
+    result = {"id": job["id"], "url": job["url"], "ok": False}
+    times = {}
+    start = last = perf_counter()
+
+    def lap(stage):
+        nonlocal last
+        now = perf_counter()
+        times[stage] = round((now - last) * 1000, 3)
+        last = now
+
+    try:
+        url = URL(job["url"])
+        if url.is_malformed: raise ValueError("Malformed url")
+        body = "".join(url.stream())
+        lap("load")
+        nodes = HTMLParser(body).parse()
+        lap("parse")
+        rules = fetch_rules(stylesheet_links(url, nodes))
+        lap("css")
+        document = style_layout(nodes, rules)
+        lap("style")
+        document.layout(job["width"])
+        lap("layout")
+        display_list = paint_display_list(document).to_data()
+        lap("paint")
+
+        result["ok"] = True
+        result["commands"] = len(display_list)
+        result["height"] = document.height
+        result["digest"] = digest(display_list)
+        if full: result["display_list"] = display_list
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+
+    result["ms"] = times
+    result["total_ms"] = round((perf_counter() - start) * 1000, 3)
+    return result
+
+def render_full(job):
+    return render_page(job, full=True)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+'''
+Render jobs on worker processes (in this process if workers <= 1), write a JSON line
+per page to out as pages finish, and return the summary dict
+previous maps id -> digest of an earlier run, pages whose digest differs get "changed": true
+'''
+def run_batch(jobs, out, workers=None, full=False, ordered=False, previous=None):
+    render = render_full if full else render_page
+    summary = {"pages": len(jobs), "ok": 0, "failed": 0, "changed": 0, "failures": []}
+    page_ms = []
+    stage_ms = {stage: [] for stage in STAGES}
+    start = perf_counter()
+
+    def record(result):
+        if result["ok"]:
+            summary["ok"] += 1
+            page_ms.append(result["total_ms"])
+            for stage in STAGES:
+                stage_ms[stage].append(result["ms"].get(stage, 0))
+            if previous is not None and result["id"] in previous:
+                result["changed"] = previous[result["id"]] != result["digest"]
+                summary["changed"] += result["changed"]
+        else:
+            summary["failed"] += 1
+            summary["failures"].append({"id": result["id"], "url": result["url"], "error": result["error"]})
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+
+    if workers is not None and workers <= 1:
+        init_worker_fonts_only()
+        for job in jobs:
+            record(render(job))
+    else:
+        with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+            chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 8))
+            results = pool.imap if ordered else pool.imap_unordered
+            for result in results(render, jobs, chunksize):
+                record(result)
+
+    elapsed = perf_counter() - start
+    summary["seconds"] = round(elapsed, 3)
+    summary["pages_per_second"] = round(len(jobs) / elapsed, 2) if elapsed else 0
+    if page_ms:
+        summary["page_ms"] = {"median": statistics.median(page_ms), "p95": percentile(page_ms, .95),
+                              "max": max(page_ms)}
+        summary["stage_median_ms"] = {stage: statistics.median(stage_ms[stage]) for stage in STAGES}
+    return summary
+
+def read_digests(path):
+    digests = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip(): continue
+            result = json.loads(line)
+            if result.get("ok"): digests[result["id"]] = result["digest"]
+    return digests
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render pages headless to display lists, as JSON lines")
+    parser.add_argument("inputs", nargs="*", help="files with one url or JSON job per line, - for stdin")
+    parser.add_argument("--url", action="append", default=[], help="a page to render, can be repeated")
+    parser.add_argument("--width", type=int, default=WIDTH)
+    parser.add_argument("--workers", type=int, default=None, help="processes, default one per CPU, 1 runs inline")
+    parser.add_argument("--output", "-o", help="write the JSON lines here instead of stdout")
+    parser.add_argument("--full", action="store_true", help="include the display lists, not only their digest")
+    parser.add_argument("--ordered", action="store_true", help="write pages in input order")
+    parser.add_argument("--compare", help="JSON lines of an earlier run, mark pages whose display list changed")
+    args = parser.parse_args(argv)
+
+    jobs = read_jobs(args.url, args.width)
+    for path in args.inputs:
+        if path == "-":
+            jobs.extend(read_jobs(sys.stdin, args.width, len(jobs)))
+        else:
+            with open(path) as f:
+                jobs.extend(read_jobs(f, args.width, len(jobs)))
+    if not jobs:
+        parser.error("no pages given")
+
+    previous = read_digests(args.compare) if args.compare else None
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        summary = run_batch(jobs, out, args.workers, args.full, args.ordered, previous)
+    finally:
+        if out is not sys.stdout: out.close()
+
+    print(f"{summary['pages']} pages in {summary['seconds']:.2f}s, "
+          f"{summary['pages_per_second']:.1f} pages/s, {summary['failed']} failed", file=sys.stderr)
+    if "page_ms" in summary:
+        stages = ", ".join(f"{stage} {ms:.1f}ms" for stage, ms in summary["stage_median_ms"].items())
+        print(f"  per page: median {summary['page_ms']['median']:.1f}ms, "
+              f"p95 {summary['page_ms']['p95']:.1f}ms ({stages})", file=sys.stderr)
+    if previous is not None:
+        print(f"  {summary['changed']} display lists changed", file=sys.stderr)
+    for failure in summary["failures"]:
+        print(f"  FAILED {failure['id']} {failure['url'][:80]}: {failure['error']}", file=sys.stderr)
+    return 1 if summary["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,531 @@
+import argparse
+import asyncio
+import gc
+import gzip
+import http.server
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import tracemalloc
+from concurrent.futures import CancelledError
+from time import perf_counter
+
+from util import elapsed_ms
+from ex1 import URL, HTMLParser, Element, MAX_REDIRECTS, fetch_all
+from network import ENGINE
+from ex6 import CSSParser, style, tree_to_list, cascade_priority
+import ex2
+from ex2 import style_layout, paint_display_list, use_headless_fonts, DEFAULT_STYLE_SHEET, WIDTH
+
+'''
+Old tokenizer, growing the buffer one character at a time
+Kept only as the baseline the fast one is measured against
+'''
+class CharHTMLParser(HTMLParser):
+    def feed(self, chunk):
+        buffer = "".join(self.buffer)
+        in_tag = self.in_tag
+
+        for c in chunk:
+            if c == "<":
+                in_tag = True
+                if buffer: self.add_text(buffer)
+                buffer = ""
+            elif c == ">":
+                in_tag = False
+                self.add_tag(buffer)
+                buffer = ""
+            else:
+                buffer += c
+
+        self.buffer = [buffer] if buffer else []
+        self.in_tag = in_tag
+
+# Collect tokens instead of building the tree, to time the tokenizer alone
+def tokens_only(parser_class):
+    class TokenParser(parser_class):
+        def __init__(self, body):
+            super().__init__(body)
+            self.tokens = []
+            self.add_text = self.tokens.append
+            self.add_tag = self.tokens.append
+
+        def finish(self):
+            return self.tokens
+    return TokenParser
+
+WORDS = [
+    "lorem", "ipsum", "dolor", "sit", "amet", "browser", "layout", "style",
+    "paint", "token", "parser", "socket", "request", "cascade", "selector",
+]
+
+# Text heavy html document of about size bytes
+def make_document(size, seed=0):
+    rand = random.Random(seed)
+    parts = ["<!doctype html><html><head><title>bench</title></head><body>"]
+    total = 0
+    while total < size:
+        words = " ".join(rand.choice(WORDS) for _ in range(rand.randint(40, 160)))
+        part = '<div class="section"><p id="p{}">{} <b>{}</b> <i>{}</i></p></div>\n'.format(
+            total, words, rand.choice(WORDS), rand.choice(WORDS))
+        parts.append(part)
+        total += len(part)
+    parts.append("</body></html>")
+    return "".join(parts)
+
+# Many small nodes (about nodes of them), for measuring DOM overhead rather than text
+def make_dom_document(nodes, seed=0):
+    rand = random.Random(seed)
+    tags = ["p", "b", "i", "small", "big", "a", "span"]
+    parts = ["<html><body>"]
+    count = 2
+    while count < nodes:
+        parts.append("<div>")
+        count += 1
+        for _ in range(rand.randint(2, 6)):
+            tag = rand.choice(tags)
+            parts.append("<{}>{}</{}> ".format(tag, rand.choice(WORDS), tag))
+            count += 2
+        parts.append("</div>")
+    parts.append("</body></html>")
+    return "".join(parts)
+
+# Stylesheet with rule_count tag and descendant rules over the tags used above
+def make_stylesheet(rule_count, seed=0):
+    rand = random.Random(seed)
+    tags = ["div", "p", "b", "i", "small", "big", "a", "span", "body"]
+    rules = []
+    for i in range(rule_count):
+        selector = " ".join(rand.choice(tags) for _ in range(rand.randint(1, 3)))
+        rules.append("{} {{ color: c{}; }}".format(selector, i))
+    return "\n".join(rules)
+
+def dump(node):
+    if isinstance(node, Element):
+        return (node.tag, node.attributes, [dump(child) for child in node.children])
+    return node.text
+
+# Smallest time in ms of runs calls
+def best_of(runs, func, *args):
+    times = []
+    for _ in range(runs):
+        ms, res = elapsed_ms(func, *args)
+        times.append(ms)
+    return min(times), res
+
+# Median of old/new time over runs, both timed back to back in each run so they see the same machine load
+def median_speedup(runs, old_func, new_func):
+    speedups = []
+    for _ in range(runs):
+        old_ms, old_res = elapsed_ms(old_func)
+        new_ms, new_res = elapsed_ms(new_func)
+        speedups.append(old_ms / new_ms)
+    return statistics.median(speedups), old_res, new_res
+
+'''
+Per character against sliced tokenizer
+- Tokens only (no tree) is where slicing pays, at least 10x
+- The full HTMLParser also builds the tree, which costs the same both ways, about 3x
+Only the tokens only speedup is asserted, the median of runs keeps one noisy run from failing it
+'''
+def bench_html_parser(size=4 * 1024 * 1024, runs=9, min_speedup=10):
+    doc = make_document(size)
+    mb = len(doc) / 1024 / 1024
+
+    old_class, new_class = tokens_only(CharHTMLParser), tokens_only(HTMLParser)
+    speedup, old_tokens, new_tokens = median_speedup(
+        runs, lambda: old_class(doc).parse(), lambda: new_class(doc).parse())
+    assert old_tokens == new_tokens, "Fast tokenizer emitted different tokens"
+    print(f"Tokenizer, tokens only, on {mb:.1f}MB: sliced is {speedup:.1f}x faster "
+          f"than per character (median of {runs})")
+
+    tree_speedup, old_tree, new_tree = median_speedup(
+        runs, lambda: CharHTMLParser(doc).parse(), lambda: HTMLParser(doc).parse())
+    assert dump(old_tree) == dump(new_tree), "Fast tokenizer built a different tree"
+    print(f"Full HTMLParser, tokens and tree, on {mb:.1f}MB: sliced is {tree_speedup:.1f}x faster "
+          f"than per character (median of {runs})")
+
+    assert speedup >= min_speedup, \
+        f"Tokenizer (tokens only) {speedup:.1f}x faster, expected at least {min_speedup}x"
+    return speedup
+
+# Memory held by the DOM after HTMLParser and after style()
+def bench_dom_memory(nodes=100_000):
+    doc = make_dom_document(nodes)
+    rules = sorted(DEFAULT_STYLE_SHEET, key=cascade_priority)
+
+    gc.collect()
+    tracemalloc.start()
+    tree = HTMLParser(doc).parse()
+    parsed = tracemalloc.get_traced_memory()[0]
+    style(tree, rules)
+    styled = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    count = len(tree_to_list(tree, []))
+    print(f"DOM of {count} nodes: parse {parsed / 1e6:.1f}MB, "
+          f"style {(styled - parsed) / 1e6:.1f}MB, {styled / count:.0f} bytes per node")
+    return styled / count
+
+def bench_style(nodes=20_000, rule_count=2_000, runs=3):
+    tree = HTMLParser(make_dom_document(nodes)).parse()
+    rules = sorted(CSSParser(make_stylesheet(rule_count)).parse(), key=cascade_priority)
+    ms, _ = best_of(runs, style, tree, rules)
+    print(f"style() of {nodes} nodes with {len(rules)} rules: {ms:.0f}ms")
+    return ms
+
+BLOCK_TAGS = ["div", "section", "article", "ul", "li", "blockquote"]
+INLINE_TAGS = ["b", "i", "small", "big", "a", "span"]
+
+'''
+Synthetic page for the stage benchmark, the same for the same arguments
+- nodes: about how many nodes the parsed tree has
+- depth: deepest nesting of block elements
+- rule_count: rules in the stylesheet, tag and descendant selectors over the tags used
+- text_density: average words per text run
+Words avoid "http", "file" and "data" since URL picks the scheme by substring, so the html
+also works as a test, url.
+Return {"html": ..., "css": ...}
+'''
+def make_corpus(nodes=5_000, depth=8, rule_count=200, text_density=12, seed=0):
+    rand = random.Random(seed)
+    parts = ['<html><head><link rel="stylesheet" href="/style.css"></head><body>']
+    count = 3
+    while count < nodes:
+        # A chain of nested blocks, with paragraphs of text at the bottom
+        chain = [rand.choice(BLOCK_TAGS) for _ in range(rand.randint(1, depth))]
+        parts.extend("<{}>".format(tag) for tag in chain)
+        count += len(chain)
+        for _ in range(rand.randint(1, 4)):
+            parts.append("<p>")
+            count += 1
+            for _ in range(rand.randint(1, 3)):
+                words = max(1, int(rand.expovariate(1 / text_density)))
+                text = " ".join(rand.choice(WORDS) for _ in range(words))
+                if rand.random() < 0.3:
+                    tag = rand.choice(INLINE_TAGS)
+                    parts.append("<{}>{}</{}> ".format(tag, text, tag))
+                    count += 2
+                else:
+                    parts.append(text + " ")
+                    count += 1
+            parts.append("</p>")
+        parts.extend("</{}>".format(tag) for tag in reversed(chain))
+    parts.append("</body></html>")
+
+    tags = BLOCK_TAGS + INLINE_TAGS + ["p", "body"]
+    properties = [("color", lambda: "c{}".format(rand.randrange(100))),
+                  ("font-size", lambda: "{}px".format(rand.randint(10, 24))),
+                  ("font-weight", lambda: rand.choice(["bold", "normal"])),
+                  ("font-style", lambda: rand.choice(["italic", "normal"])),
+                  ("background-color", lambda: "c{}".format(rand.randrange(100)))]
+    rules = []
+    for _ in range(rule_count):
+        selector = " ".join(rand.choice(tags) for _ in range(rand.randint(1, 3)))
+        body = " ".join("{}: {};".format(prop, value())
+            for prop, value in rand.sample(properties, rand.randint(1, 3)))
+        rules.append("{} {{ {} }}".format(selector, body))
+
+    return {"html": "".join(parts), "css": "\n".join(rules)}
+
+'''
+Local HTTP stand-in serving a corpus, / is the html and /style.css the stylesheet
+Any query string is ignored, so ?run=N gives a url the response cache hasn't seen
+'''
+class CorpusServer:
+    def __init__(self, corpus):
+        bodies = {
+            "/": ("text/html; charset=utf-8", corpus["html"].encode("utf-8")),
+            "/style.css": ("text/css", corpus["css"].encode("utf-8")),
+        }
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path not in bodies:
+                    self.send_error(404)
+                    return
+                content_type, body = bodies[path]
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Cache-Control", "no-store")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path="/"):
+        return "http://127.0.0.1:{}{}".format(self.server.server_port, path)
+
+'''
+Local asyncio HTTP stand-in for checking the network engine, on its own event loop thread
+- /ok...: small body, /gzip: gzipped body in chunks
+- /chainN: N redirects then a body, /loopa and /loopb: redirect to each other
+- /slow-head: headers only after 3s, /drip: one byte per 0.1s
+'''
+class EngineServer:
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.server = None
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                path = line.split()[1].decode()
+                while (await reader.readline()) not in (b"\r\n", b""): pass
+                await self.respond(path, writer)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        writer.close()
+
+    async def respond(self, path, writer):
+        def send(status, headers, body=b""):
+            head = "HTTP/1.1 {} X\r\n".format(status)
+            head += "".join(["{}: {}\r\n".format(name, value) for name, value in headers.items()])
+            writer.write(head.encode("latin-1") + b"\r\n" + body)
+
+        if path.startswith("/ok"):
+            body = path.encode("utf-8")
+            send(200, {"Content-Length": len(body)}, body)
+        elif path == "/gzip":
+            data = gzip.compress(b"zipped " * 5000)
+            chunks = b"".join([b"%x\r\n%s\r\n" % (len(data[i:i + 1000]), data[i:i + 1000])
+                               for i in range(0, len(data), 1000)])
+            send(200, {"Transfer-Encoding": "chunked", "Content-Encoding": "gzip"}, chunks + b"0\r\n\r\n")
+        elif path.startswith("/chain"):
+            left = int(path[len("/chain"):])
+            if left: send(302, {"Location": "/chain{}".format(left - 1), "Content-Length": 0})
+            else: send(200, {"Content-Length": 3}, b"end")
+        elif path in ("/loopa", "/loopb"):
+            send(301, {"Location": "/loopb" if path == "/loopa" else "/loopa", "Content-Length": 0})
+        elif path == "/slow-head":
+            await asyncio.sleep(3)
+            send(200, {"Content-Length": 2}, b"ok")
+        elif path == "/drip":
+            send(200, {"Content-Length": 100})
+            for _ in range(100):
+                writer.write(b"d")
+                await writer.drain()
+                await asyncio.sleep(0.1)
+        else:
+            send(404, {"Content-Length": 0})
+        await writer.drain()
+
+    def __enter__(self):
+        self.thread.start()
+        start = asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.server = asyncio.run_coroutine_threadsafe(start, self.loop).result()
+        return self
+
+    def __exit__(self, *exc):
+        asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # Stop listening and drop the keep-alive connections still open
+    async def close(self):
+        self.server.close()
+        handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    # localhost, so the engine's DNS cache is used
+    def url(self, path="/"):
+        return "http://localhost:{}{}".format(self.server.sockets[0].getsockname()[1], path)
+
+# Time func(), which has to raise error, return the seconds it took
+def time_error(error, func):
+    start = perf_counter()
+    try:
+        func()
+    except error:
+        return perf_counter() - start
+    raise AssertionError(f"Expected {error.__name__}")
+
+'''
+Check the network engine against an EngineServer, with short timeouts for the run
+Keep-alive reuse, DNS cache, gzip + chunked, redirect cap and cycles, read and total
+timeouts, cancellation, and many fetches sharing the one loop
+'''
+def check_network_engine(read_timeout=0.5, total_timeout=2):
+    old = ENGINE.read_timeout, ENGINE.total_timeout
+    ENGINE.read_timeout, ENGINE.total_timeout = read_timeout, total_timeout
+    try:
+        with EngineServer() as server:
+            before = ENGINE.stats()
+            assert URL(server.url("/ok1")).request()["content"] == "/ok1"
+            assert URL(server.url("/ok2")).request()["content"] == "/ok2"
+            assert ENGINE.stats()["hits"] > before["hits"], "Second request didn't reuse the connection"
+            assert URL(server.url("/gzip")).request()["content"] == "zipped " * 5000
+
+            assert URL(server.url("/chain{}".format(MAX_REDIRECTS))).request()["content"] == "end"
+            time_error(ValueError, lambda: URL(server.url("/chain{}".format(MAX_REDIRECTS + 2))).request())
+            time_error(ValueError, lambda: URL(server.url("/loopa")).request())
+
+            waited = time_error(TimeoutError, lambda: URL(server.url("/slow-head")).request())
+            assert waited < read_timeout + 1, f"Read timeout after {waited:.1f}s"
+            waited = time_error(TimeoutError, lambda: URL(server.url("/drip")).request())
+            assert waited < total_timeout + 1, f"Total timeout after {waited:.1f}s"
+            cancelled = threading.Event()
+            threading.Timer(0.2, cancelled.set).start()
+            waited = time_error(CancelledError, lambda: URL(server.url("/slow-head")).request(cancelled))
+            assert waited < read_timeout, f"Cancelled after {waited:.1f}s"
+
+            start = perf_counter()
+            results = fetch_all([URL(server.url("/ok{}".format(i))) for i in range(60)])
+            assert all([result is not None for result in results]), "Concurrent fetch failed"
+            # Timed out sockets were closed, their replacements found localhost in the cache
+            stats = ENGINE.stats()
+            assert stats["dns_misses"] - before["dns_misses"] <= 1, "localhost was resolved again"
+            assert stats["dns_hits"] > before["dns_hits"], "DNS cache unused"
+            print(f"Network engine: all checks passed, 60 concurrent fetches in "
+                  f"{(perf_counter() - start) * 1000:.0f}ms, {ENGINE.stats()}")
+    finally:
+        ENGINE.read_timeout, ENGINE.total_timeout = old
+
+STAGES = ["load", "html_parse", "css_parse", "style", "layout", "paint"]
+
+'''
+Time every stage of a page load over runs, return the median ms of each
+- transport "test" hands the html over as a test, url and parses the css in place
+- transport "http" fetches both from a CorpusServer, so load includes the network
+Font widths come from the headless backend and its caches are emptied each run,
+so every run does the same work
+'''
+def bench_stages(corpus, runs=5, transport="test", width=WIDTH):
+    use_headless_fonts()
+    times = {stage: [] for stage in STAGES}
+    counts = {}
+
+    def timed(stage, func, *args):
+        ms, res = elapsed_ms(func, *args)
+        times[stage].append(ms)
+        return res
+
+    def load(server, run):
+        if server is None:
+            return URL("test," + corpus["html"]).request()["content"], corpus["css"]
+        html = URL(server.url("/?run={}".format(run))).request()["content"]
+        css = URL(server.url("/style.css?run={}".format(run))).request()["content"]
+        return html, css
+
+    server = CorpusServer(corpus) if transport == "http" else None
+    if server: server.__enter__()
+    try:
+        for run in range(runs):
+            ex2.METRICS.clear()
+            ex2.WORD_WIDTHS.clear()
+            html, css = timed("load", load, server, run)
+            nodes = timed("html_parse", lambda: HTMLParser(html).parse())
+            sheet = timed("css_parse", lambda: CSSParser(css).parse())
+            rules = sorted(DEFAULT_STYLE_SHEET + sheet, key=cascade_priority)
+            # style builds the layout tree too, layout measures and places the words
+            document = timed("style", style_layout, nodes, rules)
+            timed("layout", document.layout, width)
+            display_list = timed("paint", paint_display_list, document)
+            counts = {"nodes": len(tree_to_list(nodes, [])), "rules": len(rules),
+                      "commands": len(display_list)}
+    finally:
+        if server: server.__exit__(None, None, None)
+
+    medians = {stage: statistics.median(times[stage]) for stage in STAGES}
+    print("{nodes} nodes, {rules} rules, {commands} draw commands".format(**counts))
+    for stage in STAGES:
+        print(f"  {stage:<11}{medians[stage]:9.1f}ms  (median of {runs})")
+    return medians
+
+'''
+Stages slower than baseline by more than tolerance (0.25 is 25%)
+Stages faster than min_ms are too noisy to judge and are only checked against min_ms
+Return a list of messages, empty when nothing regressed
+'''
+def find_regressions(medians, baseline, tolerance=0.25, min_ms=1.0):
+    regressions = []
+    for stage, ms in medians.items():
+        if stage not in baseline: continue
+        allowed = max(baseline[stage], min_ms) * (1 + tolerance)
+        if ms > allowed:
+            regressions.append(f"{stage}: {ms:.1f}ms, baseline {baseline[stage]:.1f}ms "
+                               f"(+{(ms / max(baseline[stage], 1e-9) - 1) * 100:.0f}%)")
+    return regressions
+
+# Exit 1 on a regression, 2 without a usable baseline (missing, or made with another config)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the page load stages on a synthetic corpus")
+    parser.add_argument("--nodes", type=int, default=5_000)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--rules", type=int, default=200)
+    parser.add_argument("--density", type=int, default=12, help="average words per text run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--transport", choices=["test", "http"], default="test")
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--micro", action="store_true",
+                        help="also run the tokenizer, DOM memory and style micro benchmarks")
+    parser.add_argument("--network", action="store_true",
+                        help="also check the network engine against a local stand-in server")
+    args = parser.parse_args(argv)
+
+    if args.micro:
+        bench_html_parser()
+        bench_dom_memory()
+        bench_style()
+    if args.network:
+        check_network_engine()
+
+    config = {"nodes": args.nodes, "depth": args.depth, "rules": args.rules,
+              "density": args.density, "seed": args.seed, "transport": args.transport}
+    corpus = make_corpus(args.nodes, args.depth, args.rules, args.density, args.seed)
+    print(f"Corpus: {len(corpus['html']) / 1024:.0f}KB html, {len(corpus['css']) / 1024:.0f}KB css")
+    medians = bench_stages(corpus, args.runs, args.transport)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "stages": medians}, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save-baseline to store one")
+        return 2
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline["config"] != config:
+        print(f"Baseline {args.baseline} was made with {baseline['config']}, not {config}; "
+              f"run with --save-baseline to replace it")
+        return 2
+
+    regressions = find_regressions(medians, baseline["stages"], args.tolerance)
+    if regressions:
+        print(f"REGRESSION against {args.baseline}:")
+        for regression in regressions:
+            print("  " + regression)
+        return 1
+    print(f"No stage slower than {args.baseline} by more than {args.tolerance * 100:.0f}%")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+import mmap
+import struct
+import sys
+from array import array
+
+TEXT, RECT = 0, 1
+
+'''
+Display list as columns (struct of arrays) instead of one object per command
+- kind: TEXT or RECT per command
+- left/top/right/bottom: coordinates, array('d') (right is left for text)
+- text/font/color: indexes into the string and font tables, -1 when unused
+- strings: words and colors, each one stored once
+- fonts: (size, weight, style) keys, the same keys get_font takes
+- height: height of the laid out document, for scrolling
+
+Nothing in it refers to Tk, so it can be saved, cached or sent to another process.
+to_bytes()/save() write the binary format below, from_buffer()/load() read it back with
+memoryview casts over the bytes (or an mmap), without an object per command.
+
+Binary format, little endian, every section starts 8 byte aligned
+    header     magic "BDL1", commands, strings, string bytes, fonts, (pad), height
+    left, top, right, bottom    float64 x commands each
+    text, font, color           int32 x commands each
+    kind                        uint8 x commands
+    string offsets              uint32 x (strings + 1)
+    string bytes                utf-8
+    fonts                       int32 x 3 x fonts (size, weight string, style string)
+'''
+MAGIC = b"BDL1"
+HEADER = struct.Struct("<4sIIIIId")
+LITTLE_ENDIAN = sys.byteorder == "little"
+
+def padded(size):
+    return (size + 7) & ~7
+
+'''
+Read only table of strings over offsets + utf-8 bytes, decoded when asked for
+Lets a loaded display list decode only the words that actually get drawn
+'''
+class StringTable:
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+class DisplayList:
+    def __init__(self, height=0):
+        self.kind = array("B")
+        self.left = array("d")
+        self.top = array("d")
+        self.right = array("d")
+        self.bottom = array("d")
+        self.text = array("i")
+        self.font = array("i")
+        self.color = array("i")
+        self.strings = []
+        self.fonts = []
+        self.height = height
+
+        # Only while building, string/font -> its index in the table
+        self.string_ids = {}
+        self.font_ids = {}
+
+    def intern(self, string):
+        i = self.string_ids.get(string)
+        if i is None:
+            i = self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return i
+
+    def intern_font(self, key):
+        i = self.font_ids.get(key)
+        if i is None:
+            i = self.font_ids[key] = len(self.fonts)
+            self.fonts.append(key)
+        return i
+
+    def add_text(self, left, top, bottom, text, font_key, color):
+        self.kind.append(TEXT)
+        self.left.append(left)
+        self.top.append(top)
+        self.right.append(left)
+        self.bottom.append(bottom)
+        self.text.append(self.intern(text))
+        self.font.append(self.intern_font(font_key))
+        self.color.append(self.intern(color))
+
+    # Many text commands at once, one list per column (what BlockLayout.paint does per block)
+    def add_texts(self, lefts, tops, bottoms, texts, font_keys, colors):
+        self.kind.frombytes(bytes([TEXT]) * len(lefts))
+        self.left.extend(lefts)
+        self.top.extend(tops)
+        self.right.extend(lefts)
+        self.bottom.extend(bottoms)
+        intern = self.intern
+        self.text.extend([intern(text) for text in texts])
+        # A block has few fonts and colors, intern each once
+        font_ids = {key: self.intern_font(key) for key in set(font_keys)}
+        self.font.extend([font_ids[key] for key in font_keys])
+        color_ids = {color: intern(color) for color in set(colors)}
+        self.color.extend([color_ids[color] for color in colors])
+
+    def add_rect(self, left, top, right, bottom, color):
+        self.kind.append(RECT)
+        self.left.append(left)
+        self.top.append(top)
+        self.right.append(right)
+        self.bottom.append(bottom)
+        self.text.append(-1)
+        self.font.append(-1)
+        self.color.append(self.intern(color))
+
+    def __len__(self):
+        return len(self.kind)
+
+    # Rough bytes held by the columns and strings, for cache limits
+    def size(self):
+        if hasattr(self, "buffer"): return len(self.buffer)
+        columns = [self.kind, self.left, self.top, self.right, self.bottom, self.text, self.font, self.color]
+        return sum([len(column) * column.itemsize for column in columns]) + \
+            sum([len(string) for string in self.strings])
+
+    # ("text", left, top, bottom, text, font key, color) or ("rect", left, top, right, bottom, color)
+    def __getitem__(self, i):
+        if self.kind[i] == TEXT:
+            return ("text", self.left[i], self.top[i], self.bottom[i],
+                    self.strings[self.text[i]], self.fonts[self.font[i]], self.strings[self.color[i]])
+        return ("rect", self.left[i], self.top[i], self.right[i], self.bottom[i], self.strings[self.color[i]])
+
+    def to_data(self):
+        return [self[i] for i in range(len(self))]
+
+    # Draw command i on a Tk canvas, get_font turns a font key into a Tk font
+    # Return the canvas item id
+    def execute(self, i, scroll, canvas, get_font, tags=()):
+        if self.kind[i] == TEXT:
+            return canvas.create_text(
+                self.left[i],
+                self.top[i] - scroll,
+                text=self.strings[self.text[i]],
+                font=get_font(*self.fonts[self.font[i]]),
+                anchor='nw',
+                fill=self.strings[self.color[i]],
+                tags=tags
+            )
+        return canvas.create_rectangle(
+            self.left[i],
+            self.top[i] - scroll,
+            self.right[i],
+            self.bottom[i] - scroll,
+            width=0,
+            fill=self.strings[self.color[i]],
+            tags=tags
+        )
+
+    def to_bytes(self):
+        strings = [self.strings[i] for i in range(len(self.strings))]
+        ids = {string: i for i, string in enumerate(strings)}
+        def string_id(string):
+            if string not in ids:
+                ids[string] = len(strings)
+                strings.append(string)
+            return ids[string]
+
+        # Font weights/styles go in the string table too
+        fonts = array("i")
+        for size, weight, style in self.fonts:
+            fonts.extend((size, string_id(weight), string_id(style)))
+
+        encoded = [string.encode("utf-8") for string in strings]
+        offsets = array("I", [0])
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+        blob = b"".join(encoded)
+
+        sections = [self.left, self.top, self.right, self.bottom, self.text, self.font, self.color,
+                    self.kind, offsets, blob, fonts]
+        parts = [HEADER.pack(MAGIC, len(self), len(strings), len(blob), len(self.fonts), 0, self.height)]
+        for section in sections:
+            if not isinstance(section, bytes):
+                if not LITTLE_ENDIAN:
+                    section = array(section.typecode if isinstance(section, array) else section.format, section)
+                    section.byteswap()
+                section = section.tobytes()
+            parts.append(section)
+            parts.append(b"\0" * (padded(len(section)) - len(section)))
+        return b"".join(parts)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+    '''
+    Display list over the bytes of to_bytes (bytes, bytearray, mmap, ...)
+    Columns are memoryview casts into buffer, so buffer must outlive the display list
+    and nothing can be added to it
+    '''
+    @classmethod
+    def from_buffer(cls, buffer):
+        view = memoryview(buffer).cast("B")
+        if len(view) < HEADER.size:
+            raise ValueError("Not a display list")
+        magic, count, string_count, string_bytes, font_count, _, height = HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("Not a display list")
+
+        pos = HEADER.size
+        def take(typecode, length):
+            nonlocal pos
+            size = length * array(typecode).itemsize
+            if pos + size > len(view):
+                raise ValueError("Display list is truncated")
+            section = view[pos:pos + size]
+            pos += padded(size)
+            if LITTLE_ENDIAN: return section.cast(typecode)
+            column = array(typecode, section.tobytes())
+            column.byteswap()
+            return column
+
+        display_list = cls(height)
+        display_list.left = take("d", count)
+        display_list.top = take("d", count)
+        display_list.right = take("d", count)
+        display_list.bottom = take("d", count)
+        display_list.text = take("i", count)
+        display_list.font = take("i", count)
+        display_list.color = take("i", count)
+        display_list.kind = take("B", count)
+        offsets = take("I", string_count + 1)
+        display_list.strings = StringTable(offsets, take("B", string_bytes))
+        fonts = take("i", font_count * 3)
+        strings = display_list.strings
+        display_list.fonts = [(fonts[i], strings[fonts[i + 1]], strings[fonts[i + 2]])
+                              for i in range(0, len(fonts), 3)]
+        display_list.string_ids = display_list.font_ids = None
+        display_list.buffer = buffer
+        return display_list
+
+    # Map a saved display list instead of reading it
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            if not f.seek(0, 2):
+                raise ValueError("Not a display list")
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls.from_buffer(buffer)
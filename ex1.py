@@ -1,8 +1,14 @@
+import codecs
+import hashlib
 import os
-import socket
-import ssl
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from util import elapsed_ms
+from network import ENGINE
+from util import elapsed_ms, span, pre_order_depth, DiskCache
 
 class URLScheme:
     HTTP = "http"
@@ -12,16 +18,27 @@ class URLScheme:
     VIEW_SOURCE = "view-source"
     TEST = "test"
 
+# Shared children of every leaf (Text, self closing Element), a tuple so nobody appends to it
+EMPTY_CHILDREN = ()
+
+'''
+Nodes use __slots__ so they carry no per instance __dict__
+style is set by ex6.style(), and is shared with the parent when the node changes nothing
+'''
 class Text:
+    __slots__ = ("text", "children", "parent", "style")
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
+        self.children = EMPTY_CHILDREN
         self.parent = parent
     
     def __repr__(self):
         return repr(self.text)
 
 class Element:
+    __slots__ = ("tag", "children", "parent", "attributes", "style")
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.children = []
@@ -31,6 +48,9 @@ class Element:
     def __repr__(self):
         return "<" + self.tag + ">"
 
+DELIMITER = re.compile(r"[<>]")  # lex only, HTMLParser splits with str.split
+ATTRIBUTE = re.compile(r"""([^\s=]+)(?:\s*=\s*("[^"]*"|'[^']*'|\S*))?""")
+
 class HTMLParser:
     SELF_CLOSING_TAGS = [
         "area", "base", "br", "col", "embed", "hr", "img", "input",
@@ -41,33 +61,62 @@ class HTMLParser:
         "link", "meta", "title", "style", "script",
     ]
 
-    def __init__(self, body):
+    def __init__(self, body=""):
         self.body = body
         self.unfinished = []
+        # Tokenizer state kept between feed() calls
+        self.buffer = []  # Pieces of the unfinished token, joined once it ends
+        self.in_tag = False
 
-    # Process body per character
     def parse(self):
-        buffer = ""
-        in_tag = False
-
-        for c in self.body:
+        with span("parse", bytes=len(self.body)):
+            self.feed(self.body)
+            return self.close()
+
+    '''
+    Streaming version of parse, call feed() per chunk then close() for the tree
+    - Every "<" ends a text token and every ">" ends a tag token, so split on "<" and then
+      on ">" slices all tokens out in bulk instead of growing a buffer per character
+    - A tag or text cut in half by a chunk boundary stays in buffer till the next chunk
+    - Chunks without "<" or ">" end no token, they are only appended to buffer and joined
+      with it once one arrives, so a long token over many chunks is copied once, not per chunk
+    '''
+    def feed(self, chunk):
+        if "<" not in chunk and ">" not in chunk:
+            if chunk: self.buffer.append(chunk)
+            return
+        if self.buffer:
+            self.buffer.append(chunk)
+            s = "".join(self.buffer)
+        else:
+            s = chunk
+        pieces = s.split("<")
+        rest = pieces.pop()
+
+        # Bound once, the loop runs per token
+        add_tag, add_text = self.add_tag, self.add_text
+        for piece in pieces:
+            if ">" in piece:
+                tags = piece.split(">")
+                piece = tags.pop()
+                for tag in tags: add_tag(tag)
             # append normal text before meeting start tag
-            if c == "<":
-                in_tag = True
-                if buffer: self.add_text(buffer)
-                buffer = ""
-            # end of tag, then append
-            elif c == ">":
-                in_tag = False
-                self.add_tag(buffer)
-                buffer = ""
-            else:
-                buffer += c
+            if piece: add_text(piece)
+
+        if pieces: self.in_tag = True
+        if ">" in rest:
+            tags = rest.split(">")
+            rest = tags.pop()
+            for tag in tags: add_tag(tag)
+            self.in_tag = False
+        self.buffer = [rest] if rest else []
+
+    def close(self):
+        if self.in_tag:
+            self.add_text("<" + "".join(self.buffer))
+        self.buffer = []
+        self.in_tag = False
 
-        if in_tag:
-            buffer = "<" + buffer
-            self.add_text(buffer)
-        
         return self.finish()
     
     # Process text type node
@@ -83,16 +132,21 @@ class HTMLParser:
 
     # Process html tag type node
     def add_tag(self, tag):
-        tag, attributes = self.get_attributes(tag)
+        # Closing tag has no attributes to extract
+        if tag.startswith("/"):
+            tag, attributes = tag.split(None, 1)[0].casefold(), {}
+        else:
+            tag, attributes = self.get_attributes(tag)
         
         if tag.startswith("!"): return # skip !doctype
-        if tag.isspace(): return # skip \n or whitespace after doctype
+        if not tag: return # skip empty tag, or \n or whitespace after doctype
         
         self.implicit_tags(tag) # guard to add missing body, head, or mandatory tags
 
         if tag in self.SELF_CLOSING_TAGS:
             parent = self.unfinished[-1]
             node = Element(tag, attributes, parent)
+            node.children = EMPTY_CHILDREN
             parent.children.append(node)
         elif tag.startswith("/"):
             if len(self.unfinished) == 1: return
@@ -105,25 +159,25 @@ class HTMLParser:
             self.unfinished.append(node)
 
     # Extract attributes from it's tag
+    # Quoted values may contain spaces (e.g. class="a b")
     def get_attributes(self, text):
-        parts = text.split()
+        parts = text.split(None, 1)
+        if not parts: return "", {}
         tag = parts[0].casefold()
         attributes = {}
 
-        for attrpair in parts[1:]:
-            if "=" in attrpair:
-                key, value = attrpair.split("=", 1)
-                if len(value) > 2 and value[0] in ["'", "\""]:
+        if len(parts) > 1:
+            for key, value in ATTRIBUTE.findall(parts[1]):
+                if len(value) >= 2 and value[0] in ["'", "\""] and value[-1] == value[0]:
                     value = value[1:-1]
                 attributes[key.casefold()] = value
-            else:
-                attributes[attrpair.casefold()] = ""
 
         return tag, attributes
 
     # Add missing mandatory tags such as html, head, body
     def implicit_tags(self, tag):
-        while True:
+        # Only the html/head/body levels can be missing, deeper than that nothing to do
+        while len(self.unfinished) <= 2:
             open_tags = [node.tag for node in self.unfinished]
 
             if open_tags == [] and tag != "html":
@@ -152,11 +206,192 @@ class HTMLParser:
 
         return self.unfinished.pop()
 
+DEFAULT_PORTS = {
+    URLScheme.HTTP: 80,
+    URLScheme.HTTPS: 443,
+}
+
+MAX_REDIRECTS = 10
+
+CHARSET_HEADER = re.compile(r"charset\s*=\s*[\"']?([\w.:-]+)", re.I)
+CHARSET_META = re.compile(rb"<meta[^>]+charset\s*=\s*[\"']?([\w.:-]+)", re.I)
+
+# Charset from Content-Type, else from <meta> in the first 1KB, else utf-8
+def get_charset(headers, content):
+    match = CHARSET_HEADER.search(headers.get("content-type", ""))
+    if match:
+        charset = match.group(1)
+    else:
+        match = CHARSET_META.search(content[:1024])
+        charset = match.group(1).decode("ascii") if match else "utf-8"
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return "utf-8"
+
+CACHEABLE_STATUS = {200, 301, 404}
+
+# Cache-Control directives that decide caching, others (public, immutable, ...) are ignored
+CACHE_CONTROL_DIRECTIVES = {"max-age", "no-store", "no-cache"}
+
+'''
+Cache of GET responses keyed by url
+- Memory tier is a LRU bounded by total body bytes
+- Disk tier (if cache_dir is given) keeps entries across restarts
+- Stale entries with ETag/Last-Modified are revalidated instead of dropped
+'''
+class ResponseCache:
+    def __init__(self, max_bytes=32 * 1024 * 1024, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.disk = DiskCache(cache_dir)
+        self.entries = OrderedDict()  # key -> entry, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.lock = threading.Lock()
+
+    # Return seconds the response stays fresh, None if it must not be stored
+    @staticmethod
+    def freshness(status, headers):
+        if status not in CACHEABLE_STATUS: return None
+        max_age = None
+        no_cache = False
+        for directive in headers.get("cache-control", "").casefold().split(","):
+            name, _, value = directive.strip().partition("=")
+            if name not in CACHE_CONTROL_DIRECTIVES: continue
+            if name == "no-store": return None
+            if name == "no-cache":
+                no_cache = True
+            elif name == "max-age":
+                try:
+                    max_age = int(value.strip('"'))
+                except ValueError:
+                    return None
+
+        # no-cache wins over max-age, wherever it comes in the header
+        if no_cache: return 0
+        # Without max-age only worth storing if it can be revalidated
+        if max_age is None:
+            if "etag" not in headers and "last-modified" not in headers: return None
+            max_age = 0
+        return max_age
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        if entry is None:
+            entry = self.disk.load(key)
+            if entry is not None:
+                self.put_memory(key, entry)
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry["stored_at"] < entry["max_age"]
+
+    # Conditional request headers for a stale entry
+    def validators(self, entry):
+        headers = {}
+        if "etag" in entry["headers"]:
+            headers["If-None-Match"] = entry["headers"]["etag"]
+        if "last-modified" in entry["headers"]:
+            headers["If-Modified-Since"] = entry["headers"]["last-modified"]
+        return headers
+
+    def store(self, key, status, headers, content):
+        max_age = self.freshness(status, headers)
+        if max_age is None:
+            self.remove(key)
+            return None
+        entry = {
+            "status": status,
+            "headers": headers,
+            "content": content,
+            "stored_at": time.time(),
+            "max_age": max_age,
+        }
+        self.put_memory(key, entry)
+        self.disk.save(key, entry)
+        return entry
+
+    # Server answered 304, keep the body but take the new freshness
+    def refresh(self, key, entry, headers):
+        headers = {**entry["headers"], **headers}
+        max_age = self.freshness(entry["status"], headers)
+        if max_age is None:
+            self.remove(key)
+            return entry
+        return self.store(key, entry["status"], headers, entry["content"])
+
+    def put_memory(self, key, entry):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old["content"])
+            if len(entry["content"]) > self.max_bytes: return
+            self.entries[key] = entry
+            self.size += len(entry["content"])
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted["content"])
+
+    def remove(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old["content"])
+        self.disk.remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidations": self.revalidations,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
+
+RESPONSE_CACHE = ResponseCache()
+
+'''
+Request many URLs at once on a thread pool
+- At most per_host requests run against the same server at a time
+- Return responses in the same order as urls, None for failed or timed out ones
+'''
+def fetch_all(urls, max_workers=8, per_host=4, timeout=10):
+    if not urls: return []
+    limits = {}
+    lock = threading.Lock()
+
+    def fetch(url):
+        key = (getattr(url, "scheme", None), getattr(url, "host", None), getattr(url, "port", None))
+        with lock:
+            limit = limits.setdefault(key, threading.Semaphore(per_host))
+        with limit, span("fetch", url=getattr(url, "path", "")):
+            return url.request()
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(urls)))
+    futures = [executor.submit(fetch, url) for url in urls]
+    done, _ = wait(futures, timeout=timeout)
+    # Don't wait for the slow ones, their sockets time out on their own
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    results = []
+    for future in futures:
+        if future in done and future.exception() is None:
+            results.append(future.result())
+        else:
+            results.append(None)
+    return results
+
 def print_tree(node, indent=0):
-    print(" " * indent, node)
-    if isinstance(node, Element): print(" " * indent, f"({node.attributes})")
-    for child in node.children:
-        print_tree(child, indent + 2)
+    for node, depth in pre_order_depth(node):
+        prefix = " " * (indent + 2 * depth)
+        print(prefix, node)
+        if isinstance(node, Element): print(prefix, f"({node.attributes})")
 
 class URL:
     def __init__(self, url: str):
@@ -171,6 +406,7 @@ class URL:
                 _, url = url.split(":", 1)
 
             # split url with scheme (http & example.org)
+            sep = None
             if URLScheme.HTTP in url:
                 self.scheme = URLScheme.HTTP
                 sep = "://"
@@ -186,6 +422,8 @@ class URL:
             elif URLScheme.TEST in url:
                 self.scheme = URLScheme.TEST
                 sep = ","
+            if sep is None:
+                raise ValueError("Unknown scheme in " + url)
 
             if self.scheme == URLScheme.DATA:
                 _, url = url.split(sep, 1)
@@ -202,12 +440,14 @@ class URL:
                 self.path = "/" + url
 
                 # get specified port
+                self.port = DEFAULT_PORTS[self.scheme]
                 if ":" in self.host:
                     self.host, port = self.host.split(":", 1)
-                    port = int(port)
+                    self.port = int(port)
 
             elif self.scheme == URLScheme.FILE:
-                self.path = url
+                # file:///D:/x is D:/x on Windows, file:///tmp/x is /tmp/x elsewhere
+                self.path = url if os.name == "nt" else "/" + url
 
             elif self.scheme == URLScheme.DATA:
                 self.content = url
@@ -219,71 +459,173 @@ class URL:
             print(f"Extract URL error: {e}")
             self.is_malformed = True
 
-    def request_http(self):
-        # create socket
-        s = None
-        res = ""
+    # What the url points to, for the response cache (http) and the render cache (any scheme)
+    def cache_key(self):
+        if self.scheme == URLScheme.FILE:
+            return "file://" + self.path
+        elif self.scheme in {URLScheme.DATA, URLScheme.TEST}:
+            return self.scheme + ":"
+        return "{}://{}:{}{}".format(self.scheme, self.host, self.port, self.path)
+
+    '''
+    Token that changes whenever the content behind the url does, None if there is none
+    - http(s): ETag or Last-Modified of the cached response, else a hash of its body
+      A stale entry is revalidated first (unless revalidate is False)
+      None when the response isn't cached (never requested, or not cacheable)
+    - file: modification time and size
+    - data/test: hash of the content
+    Follows cached redirects, like request() does
+    '''
+    def validator(self, revalidate=True):
+        if self.is_malformed: return None
+        if self.scheme == URLScheme.FILE:
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                return None
+            return "{}-{}".format(stat.st_mtime_ns, stat.st_size)
+        elif self.scheme not in {URLScheme.HTTP, URLScheme.HTTPS}:
+            return hashlib.sha1(self.content.encode("utf-8")).hexdigest()
+
+        seen = {self.cache_key()}
         while True:
-            s = socket.socket(
-                family=socket.AF_INET,
-                type=socket.SOCK_STREAM,
-                proto=socket.IPPROTO_TCP
-            )
-            # pick port
-            if self.scheme == URLScheme.HTTP:
-                self.port = 80
-            elif self.scheme == URLScheme.HTTPS:
-                self.port = 443
-
-            # connect
-            s.connect((self.host, self.port))
-
-            # handle https
-            if self.scheme == URLScheme.HTTPS:
-                ctx = ssl.create_default_context()
-                s = ctx.wrap_socket(s, server_hostname=self.host)
-
-            # form request
-            req = "GET {} HTTP/1.0\r\n".format(self.path)
-            req += "Host: {}\r\n".format(self.host)
-            req += "Connection: {}\r\n".format("close")
-            req += "User-Agent: {}\r\n".format("mozilla")
-            req += "\r\n"
-            s.send(req.encode("utf-8"))
-
-            # get response
-            res = s.makefile("r", encoding="utf-8", newline="\r\n")
-
-            # split response
-            statusline = res.readline()
-            version, status, explanation = statusline.split(" ", 2)
-            res_headers = {}
-            while True:
-                line = res.readline()
-                if line == "\r\n": break
-                header, value = line.split(":", 1)
-                res_headers[header.casefold()] = value.strip()
-
-            if "location" in res_headers:
-                s.close()
-                self.extract_url(res_headers["location"])
+            entry = RESPONSE_CACHE.get(self.cache_key())
+            if entry is not None and revalidate and not RESPONSE_CACHE.is_fresh(entry):
+                # A 304 keeps the entry, a new body replaces it
+                self.fetch_cached()
+                entry = RESPONSE_CACHE.get(self.cache_key())
+            if entry is None: return None
+            headers = entry["headers"]
+            if "location" not in headers: break
+            self.follow_redirect(headers["location"], seen)
+
+        if "etag" in headers:
+            return "etag " + headers["etag"]
+        elif "last-modified" in headers:
+            return "last-modified " + headers["last-modified"]
+        return hashlib.sha1(entry["content"]).hexdigest()
+
+    # Send one GET on the network engine (see network.NetworkEngine)
+    # Return status, headers, and the body bytes (already decompressed)
+    def fetch(self, headers={}, cancelled=None):
+        return ENGINE.fetch(self.scheme, self.host, self.port, self.path, headers, cancelled)
+
+    '''
+    Go to the url in a Location header, seen holds the cache keys visited so far
+    A relative Location is resolved against the current url
+    A redirect back to one of them, or more than MAX_REDIRECTS, is an error
+    '''
+    def follow_redirect(self, location, seen):
+        target = self.resolve(location)
+        if target.is_malformed:
+            raise ValueError("Bad redirect location " + location)
+        self.__dict__.update(vars(target))
+        key = self.cache_key()
+        if key in seen:
+            raise ValueError("Redirect loop at " + key)
+        if len(seen) > MAX_REDIRECTS:
+            raise ValueError("Too many redirects")
+        seen.add(key)
+
+    # Fetch through RESPONSE_CACHE
+    # Fresh entry costs a lookup, stale one a conditional request
+    def fetch_cached(self, cancelled=None):
+        key = self.cache_key()
+        entry = RESPONSE_CACHE.get(key)
+        if entry is not None and RESPONSE_CACHE.is_fresh(entry):
+            with RESPONSE_CACHE.lock:
+                RESPONSE_CACHE.hits += 1
+            return entry["status"], entry["headers"], entry["content"]
+
+        headers = RESPONSE_CACHE.validators(entry) if entry else {}
+        status, res_headers, content = self.fetch(headers, cancelled)
+        if status == 304 and entry is not None:
+            with RESPONSE_CACHE.lock:
+                RESPONSE_CACHE.revalidations += 1
+            entry = RESPONSE_CACHE.refresh(key, entry, res_headers)
+            return entry["status"], entry["headers"], entry["content"]
+
+        with RESPONSE_CACHE.lock:
+            RESPONSE_CACHE.misses += 1
+        RESPONSE_CACHE.store(key, status, res_headers, content)
+        return status, res_headers, content
+
+    '''
+    Like request_http, but yield the body as text while it is still downloading
+    - Cached (or revalidated) bodies are in memory already and come in one piece
+    - Charset is picked once the first 1KB arrived, then decoded incrementally
+    - Cacheable bodies are kept and stored once the download ends
+    '''
+    def stream_http(self, cancelled=None):
+        seen = {self.cache_key()}
+        while True:
+            key = self.cache_key()
+            store = False
+            if RESPONSE_CACHE.get(key) is not None:
+                status, res_headers, content = self.fetch_cached(cancelled)
+                chunks = [content]
             else:
-                break
-
-        # assert to exclude headers
-        assert "transfer-encoding" not in res_headers
-        assert "content-encoding" not in res_headers
+                chunks = ENGINE.stream(self.scheme, self.host, self.port, self.path, {}, cancelled)
+                status, res_headers = next(chunks)
+                store = RESPONSE_CACHE.freshness(status, res_headers) is not None
+                with RESPONSE_CACHE.lock:
+                    RESPONSE_CACHE.misses += 1
+            if "location" not in res_headers: break
+            content = b"".join(chunks)
+            if store: RESPONSE_CACHE.store(key, status, res_headers, content)
+            self.follow_redirect(res_headers["location"], seen)
+
+        kept = []
+        head = b""
+        decoder = None
+        for chunk in chunks:
+            if store: kept.append(chunk)
+            if decoder is None:
+                head += chunk
+                if len(head) < 1024: continue
+                charset = get_charset(res_headers, head)
+                decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+                chunk, head = head, b""
+            text = decoder.decode(chunk)
+            if text: yield text
+
+        if decoder is None:
+            charset = get_charset(res_headers, head)
+            decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+        text = decoder.decode(head, final=True)
+        if text: yield text
+        if store: RESPONSE_CACHE.store(key, status, res_headers, b"".join(kept))
+
+    def request_http(self, cancelled=None):
+        with span("request", url=self.cache_key()) as args:
+            seen = {self.cache_key()}
+            while True:
+                status, res_headers, content = self.fetch_cached(cancelled)
+                if "location" in res_headers:
+                    self.follow_redirect(res_headers["location"], seen)
+                else:
+                    break
+            args["bytes"] = len(content)
 
-        # read content(body) and return
-        content = res.read()
-        s.close()
+        # Decode to text only once, at the end
+        charset = get_charset(res_headers, content)
         return {
-            "content": content,
+            "content": content.decode(charset, errors="replace"),
+            "charset": charset,
             "scheme": self.scheme,
             "is_view_source": self.is_view_source
         }
 
+    # A directory gives the list of its file names, a file its decoded text
     def request_file(self):
+        if os.path.isfile(self.path):
+            with open(self.path, "rb") as f:
+                content = f.read()
+            return {
+                "content": content.decode(get_charset({}, content), errors="replace"),
+                "scheme": self.scheme
+            }
+
         file_list = []
         files = os.listdir(self.path)
         for file in files:
@@ -312,12 +654,24 @@ class URL:
             "scheme": self.scheme
         }
 
-    def request(self):
+    # Yield the body as text pieces, http(s) ones while they download
+    # The "request" span covers the whole stream, so it includes whatever the caller does per piece
+    # Setting cancelled (a threading.Event) stops an http(s) download
+    def stream(self, cancelled=None):
+        if self.is_malformed or self.scheme not in {URLScheme.HTTP, URLScheme.HTTPS}:
+            content = self.request()["content"]
+            # Directory listing, one file name per line
+            yield "\n".join(content) if isinstance(content, list) else content
+        else:
+            with span("request", url=self.cache_key(), streamed=True):
+                yield from self.stream_http(cancelled)
+
+    def request(self, cancelled=None):
         if self.is_malformed:
             return self.request_malformed()
 
         if self.scheme == URLScheme.HTTP or self.scheme == URLScheme.HTTPS:
-            return self.request_http()
+            return self.request_http(cancelled)
         elif self.scheme == URLScheme.FILE:
             return self.request_file()
         elif self.scheme == URLScheme.DATA:
@@ -338,6 +692,8 @@ class URL:
             url = dir + "/" + url
         if url.startswith("//"):
             return URL(self.scheme + ":" + url)
+        elif self.scheme == URLScheme.FILE:
+            return URL("file:///" + url.lstrip("/"))
         else:
             return URL(self.scheme + "://" + self.host + \
                        ":" + str(self.port) + url)
@@ -346,7 +702,6 @@ class URL:
 # Get Text, Element from a body / Normal parsing
 def lex(resp, mode="lex"):
     ret = []
-    buffer = ""
     scheme = resp["scheme"]
     body = resp["content"]
     is_view_source = resp.get("is_view_source", None)
@@ -357,29 +712,29 @@ def lex(resp, mode="lex"):
             ret.append(body)
         else:
             in_tag = False
-            for c in body:
+            pos = 0
+            for match in DELIMITER.finditer(body):
+                buffer = body[pos:match.start()]
                 # append normal text before meeting start tag
-                if c == "<":
+                if match.group() == "<":
                     in_tag = True
                     if len(buffer) > 0:
-                        ret.append(Text(buffer))
-                    buffer = ""
+                        ret.append(Text(buffer, None))
                 # end of tag, then append
-                elif c == ">":
-                    in_tag = False
-                    ret.append(Element(buffer))
-                    buffer = ""
                 else:
-                    buffer += c
+                    in_tag = False
+                    ret.append(Element(buffer, {}, None))
+                pos = match.end()
+            buffer = body[pos:]
             if in_tag:
                 buffer = "<" + buffer
             if len(buffer) > 0:
-                ret.append(Text(buffer))
+                ret.append(Text(buffer, None))
 
     elif scheme == URLScheme.FILE:
         for file in body:
-            ret.append(Text(file))
-            ret.append(Text("\n"))
+            ret.append(Text(file, None))
+            ret.append(Text("\n", None))
 
     elif scheme == URLScheme.DATA:
         ret.append(body)
@@ -400,6 +755,8 @@ if __name__ == "__main__":
     import sys
 
     url = sys.argv[1]
-    body = URL(url).request()
-    nodes = HTMLParser(body["content"]).parse()
+    parser = HTMLParser()
+    for chunk in URL(url).stream():
+        parser.feed(chunk)
+    nodes = parser.close()
     print_tree(nodes)
@@ -1,14 +1,38 @@
-import tkinter
-import tkinter.font
-from ex1 import URL, lex, Element, Text, HTMLParser
-from ex6 import style, CSSParser, tree_to_list, cascade_priority
+import os
+import queue
+import threading
+from array import array
+from bisect import bisect
+from collections import OrderedDict, deque
+from time import perf_counter
+from ex1 import URL, lex, Element, Text, HTMLParser, fetch_all
+from ex6 import styled, tree_to_list, cascade_priority, stylesheet_key, STYLESHEET_CACHE
+from headless import HeadlessFont
+from displaylist import DisplayList
+from util import elapsed_ms, span, TRACER, TRACE_PATH, pre_order, walk
+
+# Tk is only needed for the window, layout can run without it (see use_headless_fonts)
+try:
+    import tkinter
+    import tkinter.font
+except ImportError:
+    tkinter = None
+
+# Optional, culls the display list with array compares instead of the tile index
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 FONTS = {}
 
+# Class called like tkinter.font.Font(size=, weight=, slant=) to make fonts
+FONT_BACKEND = tkinter.font.Font if tkinter else HeadlessFont
+
 def get_font(size, weight, style):
     key = (size, weight, style)
     if key not in FONTS:
-        font = tkinter.font.Font(
+        font = FONT_BACKEND(
             size=size,
             weight=weight,
             slant=style
@@ -16,6 +40,69 @@ def get_font(size, weight, style):
         FONTS[key] = font
     return FONTS[key]
 
+# Switch font backend, fonts and metrics of the previous one are dropped
+def set_font_backend(backend):
+    global FONT_BACKEND
+    FONT_BACKEND = backend
+    FONTS.clear()
+    METRICS.clear()
+    WORD_WIDTHS.clear()
+
+# Measure text from glyph tables instead of Tk, for machines without a display
+def use_headless_fonts():
+    set_font_backend(HeadlessFont)
+
+'''
+Font metrics asked from Tk once and remembered, every Tk call is a round trip
+- ascent/descent/linespace and the width of a space, once per font
+- word widths in WORD_WIDTHS, one LRU of (font key, word) shared by all fonts
+- with APPROXIMATE_WIDTHS, a word is the sum of its cached character widths
+  (ignores kerning, but new words cost no Tk call at all)
+'''
+METRICS = {}
+WORD_WIDTHS = OrderedDict()
+MAX_WORD_WIDTHS = 50_000
+APPROXIMATE_WIDTHS = False
+
+class FontMetrics:
+    def __init__(self, key, font):
+        self.key = key
+        self.font = font
+        metrics = font.metrics()
+        self.ascent = metrics["ascent"]
+        self.descent = metrics["descent"]
+        self.linespace = metrics["linespace"]
+        self.space = font.measure(" ")
+        self.char_widths = {}
+
+    def measure(self, word):
+        if APPROXIMATE_WIDTHS:
+            return sum([self.char_width(c) for c in word])
+
+        key = (self.key, word)
+        width = WORD_WIDTHS.get(key)
+        if width is not None:
+            WORD_WIDTHS.move_to_end(key)
+            return width
+
+        width = self.font.measure(word)
+        WORD_WIDTHS[key] = width
+        if len(WORD_WIDTHS) > MAX_WORD_WIDTHS:
+            WORD_WIDTHS.popitem(last=False)
+        return width
+
+    def char_width(self, c):
+        width = self.char_widths.get(c)
+        if width is None:
+            width = self.char_widths[c] = self.font.measure(c)
+        return width
+
+def get_metrics(size, weight, style):
+    key = (size, weight, style)
+    if key not in METRICS:
+        METRICS[key] = FontMetrics(key, get_font(size, weight, style))
+    return METRICS[key]
+
 BLOCK_ELEMENTS = [
     "html", "body", "article", "section", "nav", "aside",
     "h1", "h2", "h3", "h4", "h5", "h6", "hgroup", "header",
@@ -24,12 +111,20 @@ BLOCK_ELEMENTS = [
     "figcaption", "main", "div", "table", "form", "fieldset",
     "legend", "details", "summary"
 ]
+BLOCK_TAGS = frozenset(BLOCK_ELEMENTS)
 
 HEIGHT, WIDTH = 960, 1024
 HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
+RESIZE_DELAY = 50  # ms without a new <Configure> before relayout
+OVERSCAN = 500     # px above and below the viewport kept on the canvas
+FRAME_BUDGET = 16  # ms per frame, about 60fps
+LOAD_POLL = 10     # ms between checks for results of a page load
+LAYOUT_SLICE = 8   # ms of idle time spent per slice of a partial layout
 
-DEFAULT_STYLE_SHEET = CSSParser(open("browser.css").read()).parse()
+# Next to this file, so the browser can run from any directory
+DEFAULT_STYLE_SHEET = STYLESHEET_CACHE.parse(
+    open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "browser.css")).read())
 
 class DocumentLayout:
     def __init__(self, node):
@@ -41,9 +136,34 @@ class DocumentLayout:
         self.y = None   # Start position y
         self.width = None
         self.height = None
+        self.cache_key = None   # Set when it came through RENDER_CACHE, see cached_style_layout
 
-    def layout(self):
-        self.width = WIDTH - 2*HSTEP
+        '''
+        A layout can stop part way and be continued later (see continue_layout)
+        - steps: the layout walk in progress, None once everything is laid out
+        - last: last block laid out so far, painting stops after it
+        - laid_bottom: everything above this y is laid out
+        - block_count: BlockLayouts in the tree when known (style_layout counts them)
+        - entered: blocks the current walk has got through, a settled block it skips counts
+          with its whole subtree, with block_count gives the height estimate
+        '''
+        self.steps = None
+        self.last = None
+        self.laid_bottom = None
+        self.block_count = None
+        self.entered = 0
+
+    '''
+    Can be called again with a new window width (resize)
+    The layout tree is kept, so only the parts affected by the new width are redone
+    '''
+    def layout(self, width=WIDTH):
+        self.begin_layout(width)
+        self.continue_layout()
+
+    # Start laying out for width, continue_layout does the work
+    def begin_layout(self, width=WIDTH):
+        self.width = width - 2*HSTEP
         self.x = HSTEP
         self.y = VSTEP
 
@@ -51,23 +171,77 @@ class DocumentLayout:
         - Make the node child as blocklayout
         - then recursive to do the same for the child
         '''
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
-        child.layout()
+        if not self.children:
+            self.children.append(BlockLayout(self.node, self, None))
+        self.steps = self.children[0].layout_steps()
+        self.last = None
+        self.laid_bottom = self.y
+        self.entered = 0
 
-        '''
-        Always count height at the end after recursive since total height can only be calculated 
-        after knowing the child height (kinda like height: fit-content)
-        '''
-        self.height = child.height
+    '''
+    Lay out blocks in document order until one starts below bottom, the deadline
+    (a perf_counter time) has passed, or everything is laid out
+    Stopped early, the blocks still open get the height laid out so far and the
+    document an estimated height (keeps the scroll range from jumping as the rest comes in)
+    Return whether the layout is complete
+    '''
+    def continue_layout(self, bottom=float("inf"), deadline=None):
+        if self.steps is None: return True
+        child = self.children[0]
+        with span("layout") as args:
+            for block in self.steps:
+                # Settled, the walk won't go below it, so its subtree counts now
+                self.entered += block.blocks if block.settled else 1
+                self.last = block
+                if block.y >= bottom or (deadline is not None and perf_counter() >= deadline):
+                    break
+            else:
+                self.steps = None
+                self.last = None
+            args["blocks"] = self.entered
 
-    def paint(self):
-        return []
+        if self.steps is None:
+            '''
+            Always count height at the end after recursive since total height can only be calculated
+            after knowing the child height (kinda like height: fit-content)
+            '''
+            self.height = child.height
+            self.laid_bottom = child.y + child.height
+            self.block_count = child.blocks
+            return True
+
+        last = self.last
+        self.laid_bottom = last.y + last.height if last.settled else last.y
+        block = last.parent if last.settled else last
+        while isinstance(block, BlockLayout):
+            block.height = self.laid_bottom - block.y
+            block = block.parent
+
+        laid = self.laid_bottom - child.y
+        self.height = laid
+        if self.block_count:
+            self.height = max(laid, laid * self.block_count / self.entered)
+        return False
+
+    def is_complete(self):
+        return self.steps is None
+
+    def paint(self, display_list):
+        pass
 
 # In short, it wraps node to layout to be better
 class BlockLayout:
     def __init__(self, node, parent, previous):
-        self.display_list = []
+        '''
+        Laid out words of an inline leaf as columns instead of a tuple per word
+        - xs/ys: position relative to self.x/self.y
+        - placed: index of the word in self.words
+        break_lines fills them as lists and packs them once the lines are done
+        '''
+        self.xs = array("d")
+        self.ys = array("d")
+        self.placed = array("i")
+        self.line = []  # Metrics of the words in the current line, flush() gives them their ys
 
         self.hstep = HSTEP
         self.vstep = VSTEP
@@ -85,105 +259,190 @@ class BlockLayout:
         self.parent = parent
         self.previous = previous
         self.children = []  # Layout tree
+
+        '''
+        Kept between layouts so a relayout (e.g. resize) can skip work
+        - mode: "block" or "inline", None until known (style_layout may set it up front)
+        - dirty: children/words are not built from the HTML tree yet
+        - laid_width: width of the last layout, None forces the next one
+        - words: inline leaf's measured words (word, metrics, color, width, space width), None is a <br>
+        - max_fit/min_break: any width in [max_fit, min_break) breaks the lines the same way
+        '''
+        self.mode = None
+        self.dirty = True
+        self.laid_width = None
+        self.words = []
+        self.max_fit = 0
+        self.min_break = float("inf")
+        self.settled = False    # layout() is done with this block and everything below it
+        self.blocks = 1         # BlockLayouts in this subtree, itself included, known once settled
     
     '''
     - Create layout tree
     - Now each html element has it's own layout (previously it's the tree is in a single layout)
     - Per-BlockLayout has it's own smaller display_list tree
+    Walks the blocks with an explicit stack, so any nesting depth works:
+    layout_enter places a block on the way down, layout_exit sums up its height on the way up
     '''
     def layout(self):
+        for _ in self.layout_steps():
+            pass
+
+    # The same walk, yielding every block once it is placed, so it can be stopped between blocks
+    def layout_steps(self):
+        for block, entering in walk(self, prune=BlockLayout.is_settled):
+            if entering:
+                block.layout_enter()
+                yield block
+            else:
+                block.layout_exit()
+
+    # Nothing left to do below this block, its children are skipped
+    def is_settled(self):
+        return self.settled
+
+    def layout_enter(self):
         # Set x starting point and width to parent
-        self.x = self.parent.x
-        self.width = self.parent.width
+        x = self.parent.x
+        width = self.parent.width
 
         # Set y starting point taking account siblings height or parent's height
         if self.previous:
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else:
-            self.y = self.parent.y
+            y = self.parent.y
 
-        mode = self.layout_mode()
-        
-        if mode == "block":
-            previous = None
-
-            for child in self.node.children:
-                next = BlockLayout(child, self, previous)
-                self.children.append(next)
-                previous = next
-        else: # Leaf node in layout tree
-            self.cursor_x = 0
-            self.cursor_y = 0
-            self.weight = "normal"
-            self.style = "roman"
-            self.size = 12
-            
-            '''
-            Since it's leaf node, then we can generate the x, y, word, font to be added to display_list
-            '''
-            self.line = []
-            self.recurse(self.node)
-            self.flush()
+        # Same constraints as last time and nothing changed inside, at most it moved
+        if not self.dirty and width == self.laid_width and x == self.x:
+            if y != self.y: self.move_by(y - self.y)
+            self.settled = True
+            return
 
-        # For each children recursively do the same
-        for child in self.children:
-            child.layout()
-        
-        # Like the root layout, can calculate height after the child height is calculated
-        if mode == "block":
-            self.height = sum([child.height for child in self.children])
+        self.x = x
+        self.width = width
+        self.y = y
+
+        if self.dirty:
+            if self.mode is None: self.mode = self.layout_mode()
+            if self.mode == "block":
+                self.build_children()
+            else: # Leaf node in layout tree
+                '''
+                Since it's leaf node, measure its words once, line breaking uses them from now on
+                '''
+                self.words = []
+                self.recurse(self.node)
+            self.dirty = False
+            self.laid_width = None
+
+        if self.mode == "block":
+            # Children are laid out next, then layout_exit
+            # Until then a relayout can't skip this block, even if the layout stops part way
+            self.settled = False
+            self.laid_width = None
         else:
+            # Break lines again only if the new width changes where they break
+            if self.laid_width is None or not (self.max_fit <= width < self.min_break):
+                self.break_lines()
             self.height = self.cursor_y
+            self.laid_width = width
+            self.settled = True
+
+    def layout_exit(self):
+        if self.settled: return
+        # Like the root layout, can calculate height after the child height is calculated
+        self.height = sum([child.height for child in self.children])
+        self.blocks = 1 + sum([child.blocks for child in self.children])
+        self.laid_width = self.width
 
-    # Determine whether a node is a block or inline
+    # Moved without changing size, positions inside are relative so only y has to follow
+    def move_by(self, dy):
+        for block in pre_order(self):
+            block.y += dy
+
+    # One BlockLayout per child of the HTML node, chained by previous
+    def build_children(self):
+        previous = None
+        self.children = []
+        for child in self.node.children:
+            next = BlockLayout(child, self, previous)
+            self.children.append(next)
+            previous = next
+
+    # Determine whether a node is a block or inline, stops at the first block child
     def layout_mode(self):
-        if isinstance(self.node, Text):
-            return "inline"
-        elif any([isinstance(child, Element) and \
-            child.tag in BLOCK_ELEMENTS
-            for child in self.node.children]):
-            return "block"
-        elif self.node.children:
+        node = self.node
+        if isinstance(node, Text):
             return "inline"
-        else:
+        elif not node.children:
             return "block"
+        for child in node.children:
+            if isinstance(child, Element) and child.tag in BLOCK_TAGS:
+                return "block"
+        return "inline"
 
-    # Determine coordinate of word
-    def handleWord(self, node, word):
+    # Font metrics and color of a text node, from its computed style
+    def text_style(self, node):
         weight = node.style["font-weight"]
         style = node.style["font-style"]
         if style == "normal": style = "roman"
         size = int(float(node.style["font-size"][:-2]) * .75)
-        font = get_font(size, weight, style)
+        return get_metrics(size, weight, style), node.style["color"]
 
-        word_width = font.measure(word)
-        if self.cursor_x + word_width > self.width:
-            self.flush()
-        color = node.style["color"]
-        self.line.append((self.cursor_x, word, font, color))
-        self.cursor_x += word_width + font.measure(" ")
+    '''
+    Determine coordinate of every word for the current width
+    Also records the range of widths that would give the same lines (max_fit, min_break)
+    '''
+    def break_lines(self):
+        self.xs, self.ys, self.placed = [], [], []
+        self.line = []
+        self.cursor_x = 0
+        self.cursor_y = 0
+        self.max_fit = 0
+        self.min_break = float("inf")
+
+        xs, placed, line, width = self.xs, self.placed, self.line, self.width
+        for i, item in enumerate(self.words):
+            if item is None:
+                self.flush()
+                continue
+
+            word_width = item[3]
+            needed = self.cursor_x + word_width
+            # The first word of a line goes there whatever the width is
+            if needed > width:
+                if line: self.min_break = min(self.min_break, needed)
+                self.flush()
+            elif line:
+                self.max_fit = max(self.max_fit, needed)
+            xs.append(self.cursor_x)
+            placed.append(i)
+            line.append(item[1])
+            self.cursor_x += word_width + item[4]
+
+        self.flush()
+        self.xs = array("d", xs)
+        self.ys = array("d", self.ys)
+        self.placed = array("i", placed)
 
     '''
-    1. Flush [array]line
-    2. Append the line to [array]display_list
-    3. Determine max_ascent, max_descent, and baseline for every word position
+    1. Flush the current line
+    2. Determine max_ascent, max_descent, and baseline for every word position
+    3. Add the ys of the line, it now belongs to the laid out words
     '''
     def flush(self):
-        if not self.line: return
-        metrics = [font.metrics() for x, word, font, color in self.line]
-        max_ascent = max([metric["ascent"] for metric in metrics])
-        max_descent = max([metric["descent"] for metric in metrics])
+        line = self.line
+        if not line: return
+        max_ascent = max([metrics.ascent for metrics in line])
+        max_descent = max([metrics.descent for metrics in line])
         baseline = self.cursor_y + 1.25 * max_ascent
 
-        for rel_x, word, font, color in self.line:
-            x = self.x + rel_x
-            y = self.y + baseline - font.metrics("ascent")
-            self.display_list.append((x, y, word, font, color))
+        self.ys.extend([baseline - metrics.ascent for metrics in line])
 
         # Reset cursor_x, move cursor_y at the end of flush
         self.cursor_x = 0
         self.cursor_y = baseline + 1.25 * max_descent
-        self.line = []
+        line.clear()
 
     # Change style (obsolete)
     def open_tag(self, tag):
@@ -213,91 +472,425 @@ class BlockLayout:
             self.cursor_y += self.vstep
 
     '''
-    Recursively convert (calling handleWord and flush) to x, y, font, blabla.
+    Collect measured words (word, metrics, color, width, space), break_lines places them.
     Btw the self.open_tag/close_tag work since class recursive is not creating a new instance.
-    Note: this traverse HTML tree
+    Note: this traverse HTML tree, the font is looked up once per text node, not per word
     '''
     def recurse(self, node):
-        if isinstance(node, Text):
-            for word in node.text.split():
-                self.handleWord(node, word)
-
-        else:
-            if node.tag == "br":
-                self.flush()
-            for child in node.children:
-                self.recurse(child)
+        words = self.words
+        for node in pre_order(node):
+            if isinstance(node, Text):
+                metrics, color = self.text_style(node)
+                measure, space = metrics.measure, metrics.space
+                for word in node.text.split():
+                    words.append((word, metrics, color, measure(word), space))
+            elif node.tag == "br":
+                words.append(None)
 
     '''
-    From existing display_list, convert to DrawText/DrawRect
+    Add the background and the laid out words to display_list (a DisplayList)
+    Words go straight into its columns, no command object per word
     '''
-    def paint(self):
-        cmds = []
+    def paint(self, display_list):
         bgcolor = self.node.style.get("background-color",
                                       "transparent")
 
         if bgcolor != "transparent":
             x2, y2 = self.x + self.width, self.y + self.height
-            rect = DrawRect(self.x, self.y, x2, y2, bgcolor)
-            cmds.append(rect)
+            display_list.add_rect(self.x, self.y, x2, y2, bgcolor)
         
-        if self.layout_mode() == "inline":
-            for x, y, word, font, color in self.display_list:
-                cmds.append(DrawText(x, y, word, font, color))
+        if self.mode == "inline" and self.placed:
+            x, y, words = self.x, self.y, self.words
+            placed = [words[i] for i in self.placed]
+            tops = [y + rel_y for rel_y in self.ys]
+            display_list.add_texts(
+                [x + rel_x for rel_x in self.xs],
+                tops,
+                [top + item[1].linespace for top, item in zip(tops, placed)],
+                [item[0] for item in placed],
+                [item[1].key for item in placed],
+                [item[2] for item in placed])
 
-        return cmds
+'''
+Note: Traversing layout tree
+Paint every layout object into display_list (a DisplayList)
+Stops after last when given, what comes after it is not laid out yet
+'''
+def paint_tree(layout_object, display_list, last=None):
+    for layout_object in pre_order(layout_object):
+        layout_object.paint(display_list)
+        if layout_object is last: break
 
-class DrawText():
-    def __init__(self, x1, y1, text, font, color):
-        self.top = y1
-        self.left = x1
-        self.text = text
-        self.font = font
-        self.color = color
-        self.bottom = y1 + font.metrics("linespace")
-
-    def execute(self, scroll, canvas):
-        canvas.create_text(
-            self.left,
-            self.top - scroll,
-            text=self.text,
-            font=self.font,
-            anchor='nw',
-            fill=self.color
-        )
+# Paint a laid out DocumentLayout into a new DisplayList (no Tk references, can be saved)
+# A partly laid out one gets what is laid out so far
+def paint_display_list(document):
+    display_list = DisplayList(document.height)
+    paint_tree(document, display_list, document.last)
+    return display_list
 
-class DrawRect():
-    def __init__(self, x1, y1, x2, y2, color):
-        self.top = y1
-        self.left = x1
-        self.bottom = y2
-        self.right = x2
-        self.color = color
-    
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
-            self.left,
-            self.top - scroll,
-            self.right,
-            self.bottom - scroll,
-            width=0,
-            fill=self.color
-        )
+TILE_HEIGHT = 256
 
 '''
-Note: Traversing layout tree
-Convert display_list to DrawText/DrawRect
-Return the result to the passed display_list
+Display list bucketed into horizontal tiles of TILE_HEIGHT pixels
+- A command is put in every tile its top..bottom touches
+- query_indexes() only looks at the tiles the viewport touches, so it costs about the
+  same on a short page and a very long one
+- Indexes come back in display list order, so painting order stays the same
+Works on a DisplayList's top/bottom columns
+With NumPy and a DisplayList there are no tiles: a query compares the whole top/bottom
+columns at once, which is faster than building the tiles. The DisplayList can't grow after.
+'''
+class DisplayListIndex:
+    def __init__(self, display_list, tile_height=TILE_HEIGHT):
+        self.display_list = display_list
+        self.tile_height = tile_height
+        self.tiles = []  # tile number -> display list indexes, ascending
+        self.vector = numpy is not None and isinstance(display_list, DisplayList)
+        if self.vector:
+            # Views of the columns, nothing is copied
+            self.tops = numpy.frombuffer(display_list.top, dtype=numpy.float64)
+            self.bottoms = numpy.frombuffer(display_list.bottom, dtype=numpy.float64)
+            return
+        self.tops, self.bottoms = display_list.top, display_list.bottom
+
+        for i, (top, bottom) in enumerate(zip(self.tops, self.bottoms)):
+            first, last = self.tile_range(top, bottom)
+            while len(self.tiles) <= last:
+                self.tiles.append([])
+            for tile in range(first, last + 1):
+                self.tiles[tile].append(i)
+
+    def tile_range(self, top, bottom):
+        first = max(int(top // self.tile_height), 0)
+        last = max(int(bottom // self.tile_height), first)
+        return first, last
+
+    # Indexes (ascending) of commands with bottom >= top and top <= bottom, same test Browser.draw used to do
+    def query_indexes(self, top, bottom):
+        if self.vector:
+            return numpy.flatnonzero((self.bottoms >= top) & (self.tops <= bottom)).tolist()
+        first, last = self.tile_range(top, bottom)
+        tiles = self.tiles[first:last + 1]
+        if not tiles: return []
+        if len(tiles) == 1:
+            indexes = tiles[0]
+        else:
+            # Tall commands sit in several tiles, keep each once
+            indexes = sorted(set().union(*tiles))
+
+        tops, bottoms = self.tops, self.bottoms
+        return [i for i in indexes if bottoms[i] >= top and tops[i] <= bottom]
+
+# Request and parse, while the body is still downloading
+# Stop early (return None) once cancelled is set
+def parse_page(url: URL, cancelled=None):
+    parser = HTMLParser()
+    for chunk in url.stream(cancelled):
+        if cancelled is not None and cancelled.is_set(): return None
+        with span("parse", bytes=len(chunk)):
+            parser.feed(chunk)
+    with span("parse") as args:
+        nodes = parser.close()
+        if TRACER.enabled: args["nodes"] = len(tree_to_list(nodes, []))
+    return nodes
+
+# Get all the url of css files
+def stylesheet_links(url: URL, nodes):
+    links = [node.attributes["href"]
+        for node in tree_to_list(nodes, [])
+        if isinstance(node, Element)
+        and node.tag == "link"
+        and node.attributes.get("rel") == "stylesheet"
+        and "href" in node.attributes]
+    style_urls = []
+    for link in links:
+        try:
+            style_urls.append(url.resolve(link))
+        except:
+            continue
+    return style_urls
+
+# Text of the linked stylesheets, fetched all at once but kept in document order
+def fetch_stylesheets(style_urls):
+    return [style_res["content"] for style_res in fetch_all(style_urls)
+            if style_res is not None and isinstance(style_res["content"], str)]
+
+# Default rules plus the stylesheets, sorted for the cascade
+def cascade_rules(sheets):
+    rules = DEFAULT_STYLE_SHEET.copy()
+    for sheet in sheets:
+        try:
+            rules.extend(STYLESHEET_CACHE.parse(sheet))
+        except:
+            continue
+    return sorted(rules, key=cascade_priority)
+
+# Default rules plus the linked stylesheets, sorted for the cascade
+def fetch_rules(style_urls):
+    return cascade_rules(fetch_stylesheets(style_urls))
+
+'''
+Style the tree and build its layout tree in the same walk
+- A node is styled on the way down, then if it is in the layout tree its mode is
+  decided and, for block mode, its children's BlockLayouts are made
+- Only nodes in the layout tree get a BlockLayout, nothing below an inline leaf does
+- Words are not measured here (that needs fonts), the first layout() does it
+Return a DocumentLayout ready for layout()
 '''
-def paint_tree(layout_object, display_list):
-    display_list.extend(layout_object.paint())
+def style_layout(nodes, rules):
+    document = DocumentLayout(nodes)
+    root = BlockLayout(nodes, document, None)
+    document.children.append(root)
 
-    for child in layout_object.children:
-        paint_tree(child, display_list)
+    with span("style_layout", rules=len(rules)) as args:
+        # Per open HTML node, an iterator over its children's BlockLayouts (None when it has none)
+        blocks = [iter((root,))]
+        count = 0
+        for node, entering in styled(nodes, rules):
+            if not entering:
+                blocks.pop()
+                continue
+            siblings = blocks[-1]
+            block = next(siblings) if siblings is not None else None
+            if block is not None:
+                count += 1
+                block.mode = block.layout_mode()
+                if block.mode == "block":
+                    block.build_children()
+                    block.dirty = False
+                    blocks.append(iter(block.children))
+                    continue
+            blocks.append(None)
+        args["blocks"] = count
+    document.block_count = count
+    return document
+
+'''
+Cache of what a page load makes, so showing a page again skips the stages whose input
+did not change (back to a page, reopening it, reload of an unchanged page)
+- "dom": parsed HTML tree, by page
+- "styled": DocumentLayout from style_layout, by page and stylesheet hashes
+- "display_list": DisplayList, by page, stylesheet hashes and layout width
+A page is (url cache key, url validator), so a changed response misses every level.
+Each level is a LRU, the trees bounded by node count and the display lists by bytes.
+Styles are stored in the nodes, so styling a cached DOM for other stylesheets drops the
+styled entries built on it. Display lists don't refer to the tree and stay.
+'''
+class RenderCache:
+    def __init__(self, max_nodes=500_000, max_bytes=64 * 1024 * 1024):
+        self.limits = {"dom": max_nodes, "styled": max_nodes, "display_list": max_bytes}
+        self.levels = {level: OrderedDict() for level in self.limits}  # key -> (value, size)
+        self.sizes = dict.fromkeys(self.limits, 0)
+        self.hits = dict.fromkeys(self.limits, 0)
+        self.misses = dict.fromkeys(self.limits, 0)
+        self.lock = threading.Lock()
+
+    def get(self, level, key):
+        with self.lock:
+            entry = self.levels[level].get(key)
+            if entry is None:
+                self.misses[level] += 1
+                return None
+            self.levels[level].move_to_end(key)
+            self.hits[level] += 1
+            return entry[0]
+
+    def put(self, level, key, value, size):
+        with self.lock:
+            entries = self.levels[level]
+            old = entries.pop(key, None)
+            if old is not None:
+                self.sizes[level] -= old[1]
+            if size > self.limits[level]: return
+            entries[key] = (value, size)
+            self.sizes[level] += size
+            while self.sizes[level] > self.limits[level]:
+                _, (_, evicted) = entries.popitem(last=False)
+                self.sizes[level] -= evicted
+
+    # The nodes of page are about to be styled again
+    def drop_styled(self, page):
+        with self.lock:
+            entries = self.levels["styled"]
+            for key in [key for key in entries if key[0] == page]:
+                self.sizes["styled"] -= entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            for level in self.levels:
+                self.levels[level].clear()
+                self.sizes[level] = 0
+
+    def stats(self):
+        with self.lock:
+            return {level: {"hits": self.hits[level], "misses": self.misses[level],
+                            "entries": len(self.levels[level]), "size": self.sizes[level]}
+                    for level in self.levels}
+
+RENDER_CACHE = RenderCache()
+
+'''
+parse_page through RENDER_CACHE
+Return (page, nodes, cached), page is the render cache key of the page (None when it
+can't be cached), nodes is None if cancelled, cached tells whether nodes came from the cache
+'''
+def cached_parse_page(url: URL, cancelled=None):
+    validator = url.validator()
+    page = (url.cache_key(), validator) if validator else None
+    nodes = RENDER_CACHE.get("dom", page) if page else None
+    if nodes is not None: return page, nodes, True
+
+    nodes = parse_page(url, cancelled)
+    if nodes is None: return page, None, False
+    # A first request is cached by now (if cacheable), it was just downloaded so no revalidation
+    if page is None:
+        validator = url.validator(revalidate=False)
+        page = (url.cache_key(), validator) if validator else None
+    if page is not None:
+        RENDER_CACHE.put("dom", page, nodes, len(tree_to_list(nodes, [])))
+    return page, nodes, False
+
+# style_layout through RENDER_CACHE, sheets is the text of the linked stylesheets
+def cached_style_layout(page, nodes, sheets):
+    if page is None: return style_layout(nodes, cascade_rules(sheets))
+    key = (page, tuple([stylesheet_key(sheet) for sheet in sheets]))
+    document = RENDER_CACHE.get("styled", key)
+    if document is None:
+        RENDER_CACHE.drop_styled(page)
+        document = style_layout(nodes, cascade_rules(sheets))
+        document.cache_key = key
+        RENDER_CACHE.put("styled", key, document, len(tree_to_list(nodes, [])))
+    return document
+
+# paint_display_list through RENDER_CACHE, for a document from cached_style_layout
+# Only a complete layout is stored, a partial one still gets a stored display list
+def cached_paint(document):
+    if document.cache_key is None: return paint_display_list(document)
+    key = (document.cache_key, document.width)
+    display_list = RENDER_CACHE.get("display_list", key)
+    if display_list is None:
+        display_list = paint_display_list(document)
+        if document.is_complete():
+            RENDER_CACHE.put("display_list", key, display_list, display_list.size())
+    return display_list
+
+'''
+Everything Browser.load does before layout: request, parse, fetch stylesheets, style
+Return a new DocumentLayout from style_layout, not laid out yet
+Goes around RENDER_CACHE, the DOM and document there may be the ones a Browser is showing
+'''
+def load_page(url: URL):
+    nodes = parse_page(url)
+    return style_layout(nodes, fetch_rules(stylesheet_links(url, nodes)))
+
+'''
+Load a page on a worker thread, in stages, each one through RENDER_CACHE
+1. request + parse, then style with the default sheet and post "first" (first paint)
+   Skipped for a cached DOM, the page was shown before and the rest is likely cached too
+2. fetch the linked stylesheets, restyle and post "done"
+Both payloads are a DocumentLayout from style_layout, ready for layout()
+Results go to the results queue as (load, stage, payload), Browser.poll_load picks them up
+on the Tk thread. Layout stays on the Tk thread since Tk fonts aren't thread safe.
+cancel() makes the worker stop at the next stage (or chunk) boundary.
+'''
+class PageLoad:
+    def __init__(self, url: URL, results):
+        self.url = url
+        self.results = results
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def post(self, stage, payload):
+        if not self.cancelled.is_set():
+            self.results.put((self, stage, payload))
+
+    def run(self):
+        try:
+            page, nodes, cached = cached_parse_page(self.url, self.cancelled)
+            if nodes is None: return
+
+            style_urls = stylesheet_links(self.url, nodes)
+            if style_urls and not cached:
+                self.post("first", style_layout(nodes, sorted(DEFAULT_STYLE_SHEET, key=cascade_priority)))
+                if self.cancelled.is_set(): return
+
+            # The first paint may still be laying out this tree, it is drawn again on "done"
+            self.post("done", cached_style_layout(page, nodes, fetch_stylesheets(style_urls)))
+        except Exception as e:
+            self.post("error", e)
+
+'''
+Layout and paint without a window, document is a DocumentLayout (see style_layout)
+or an already styled tree
+Return the display list as plain data (see DisplayList.to_data)
+Call use_headless_fonts() first on machines without a display
+'''
+def render(document, width=WIDTH):
+    if not isinstance(document, DocumentLayout):
+        document = DocumentLayout(document)
+    document.layout(width)
+    with span("paint") as args:
+        display_list = paint_display_list(document)
+        args["commands"] = len(display_list)
+    return display_list.to_data()
+
+'''
+Run render at most once per frame, no matter how many events asked for it
+- request() schedules the next frame with window.after, extra requests before it runs are merged
+- Frames start at least budget ms apart
+- A frame taking longer than budget counts the frames it overran as dropped
+'''
+class FrameScheduler:
+    def __init__(self, window, render, budget=FRAME_BUDGET):
+        self.window = window
+        self.render = render
+        self.budget = budget
+        self.job = None
+        self.last_start = None
+        self.frames = 0
+        self.dropped = 0
+        self.requests = 0
+        self.frame_times = deque(maxlen=240)  # ms of the last frames
+
+    def request(self):
+        self.requests += 1
+        if self.job is not None: return
+        delay = 0
+        if self.last_start is not None:
+            since = (perf_counter() - self.last_start) * 1000
+            delay = max(int(self.budget - since), 0)
+        self.job = self.window.after(delay, self.run)
+
+    def run(self):
+        self.job = None
+        self.last_start = perf_counter()
+        ms, _ = elapsed_ms(self.render)
+        self.frames += 1
+        self.frame_times.append(ms)
+        if ms > self.budget:
+            self.dropped += int(ms // self.budget)
+
+    def stats(self):
+        times = sorted(self.frame_times)
+        return {
+            "frames": self.frames,
+            "requests": self.requests,
+            "dropped": self.dropped,
+            "avg_ms": sum(times) / len(times) if times else 0,
+            "p95_ms": times[int(len(times) * .95)] if times else 0,
+            "max_ms": times[-1] if times else 0,
+        }
 
 class Browser:
     def __init__(self):
-        self.display_list = []
+        self.display_list = DisplayList()
+        self.display_index = DisplayListIndex(self.display_list)
         self.hstep = HSTEP
         self.vstep = VSTEP
         self.width = WIDTH
@@ -314,6 +907,27 @@ class Browser:
             expand=1
         )
         self.scroll_val = 0
+        self.document = None
+        self.resize_job = None
+        '''
+        Retained canvas: items stay on the canvas while they are inside the overscan band
+        - items: display list index -> canvas item id
+        - drawn_scroll: scroll_val the items are currently positioned for
+        '''
+        self.items = {}
+        self.drawn_scroll = 0
+        self.needs_relayout = False
+        '''
+        Virtualized layout: a document is laid out down to the overscan band first, the
+        rest in idle time slices or as scrolling gets close to it
+        - painted_bottom: the display list covers everything above this y
+        - layout_job: pending idle slice
+        '''
+        self.painted_bottom = float("inf")
+        self.layout_job = None
+        self.scheduler = FrameScheduler(self.window, self.frame)
+        self.page_load = None
+        self.load_results = queue.Queue()
         self.bind_keys()
 
     def bind_keys(self):
@@ -329,9 +943,94 @@ class Browser:
         if abs(self.width - width) > 1 or abs(self.height - height) > 1:
             self.width = width
             self.height = height
-            # TODO: Handle reposition text
-            self.canvas.delete("all")
+            # A drag resize fires many events, relayout once they stop
+            if self.resize_job:
+                self.window.after_cancel(self.resize_job)
+            self.resize_job = self.window.after(RESIZE_DELAY, self.request_relayout)
+
+    def request_relayout(self):
+        self.resize_job = None
+        self.needs_relayout = True
+        self.scheduler.request()
+
+    # One frame: apply what the events since the last frame asked for, then draw once
+    def frame(self):
+        if self.needs_relayout:
+            self.needs_relayout = False
+            self.relayout()
+        self.layout_ahead()
+        self.draw()
+
+    # Layout again for the current width, the layout tree is reused so mostly lines are rebroken
+    def relayout(self):
+        if self.document is None: return
+        self.layout_visible()
+
+    # Lay out and paint down to the bottom of the overscan band, the rest comes later
+    def layout_visible(self):
+        self.document.begin_layout(self.width)
+        self.document.continue_layout(self.scroll_val + self.height + OVERSCAN)
+        self.paint()
+        self.scroll_val = min(self.scroll_val, self.max_scroll())
+        self.schedule_layout_slice()
+
+    # Scrolled close to what is not painted yet, lay out and paint a screen past the band now
+    def layout_ahead(self):
+        document = self.document
+        bottom = self.scroll_val + self.height + OVERSCAN
+        if document is None or bottom <= self.painted_bottom: return
+        if bottom > document.laid_bottom:
+            document.continue_layout(bottom + self.height)
+        self.paint()
+        self.scroll_val = min(self.scroll_val, self.max_scroll())
+        self.schedule_layout_slice()
+
+    def schedule_layout_slice(self):
+        if self.layout_job is None and not self.document.is_complete():
+            self.layout_job = self.window.after_idle(self.layout_slice)
+
+    # Idle time: lay out some more of a partial layout, paint and draw once it is complete
+    def layout_slice(self):
+        self.layout_job = None
+        document = self.document
+        if document is None or document.is_complete(): return
+        if document.continue_layout(deadline=perf_counter() + LAYOUT_SLICE / 1000):
+            self.paint()
+            self.scroll_val = min(self.scroll_val, self.max_scroll())
             self.draw()
+        else:
+            self.schedule_layout_slice()
+
+    # Rebuild the display list (and its index) from the layout tree
+    def paint(self):
+        with span("paint") as args:
+            self.display_list = cached_paint(self.document)
+            self.display_index = DisplayListIndex(self.display_list)
+            args["commands"] = len(self.display_list)
+        self.painted_bottom = float("inf") if self.document.is_complete() else self.document.laid_bottom
+        self.clear_canvas()
+
+    # Canvas items belong to the old display list
+    def clear_canvas(self):
+        self.canvas.delete("all")
+        self.items = {}
+        self.drawn_scroll = self.scroll_val
+
+    # Draw a DisplayList made earlier (e.g. DisplayList.load), without any layout
+    # There is no layout tree behind it, so a resize keeps it as it is
+    def show_display_list(self, display_list):
+        self.document = None
+        self.display_list = display_list
+        self.display_index = DisplayListIndex(display_list)
+        self.clear_canvas()
+        self.scroll_val = min(self.scroll_val, self.max_scroll())
+        self.draw()
+
+    # Max_y is the document height (kept in the display list)
+    # - by height since that much content is already shown initially
+    # + 2*VSTEP whitespace top/bottom page
+    def max_scroll(self):
+        return max(self.display_list.height + 2*VSTEP - self.height, 0)
 
     def scroll(self, direction):
         display_list = self.display_list
@@ -339,10 +1038,7 @@ class Browser:
             return
         
         if direction == "<Down>":
-            # Max_y is self.document.height
-            # - by HEIGHT since that much content is already shown initially
-            # + 2*VSTEP whitespace top/bottom page
-            max_y = max(self.document.height + 2*VSTEP - HEIGHT, 0)
+            max_y = self.max_scroll()
             
             # Guard when scrolling beyond the whole content height
             self.scroll_val = min(self.scroll_val + SCROLL_STEP, max_y)
@@ -350,7 +1046,8 @@ class Browser:
         elif direction == "<Up>":
             self.scroll_val = max(self.scroll_val - SCROLL_STEP, 0)
 
-        self.draw()
+        # Key repeat and wheel spins add up, drawn once in the next frame
+        self.scheduler.request()
 
     def handle_mouse_wheel(self, e):
         if e.delta < 0:
@@ -358,51 +1055,109 @@ class Browser:
         elif e.delta > 0:
             self.scroll("<Up>")
 
+    # Start loading url on a worker, a load still running for the previous url is cancelled
     def load(self, url: URL):
-        # Getting html nodes
-        res = url.request()
-        self.nodes = HTMLParser(res["content"]).parse()
-        
-        # Styling
-        rules = DEFAULT_STYLE_SHEET.copy()
-        links = [node.attributes["href"]    # Get all the url of css files
-            for node in tree_to_list(self.nodes, [])
-            if isinstance(node, Element)
-            and node.tag == "link"
-            and node.attributes.get("rel") == "stylesheet"
-            and "href" in node.attributes]
-        for link in links:
-            style_url = url.resolve(link)
+        if self.page_load is not None:
+            self.page_load.cancel()
+        self.page_load = PageLoad(url, self.load_results)
+        self.page_load.start()
+        self.scroll_val = 0
+        self.poll_load()
+
+    # Runs on the Tk thread, shows whatever the worker has finished so far
+    def poll_load(self):
+        while True:
             try:
-                style_res = style_url.request()
-                body = style_res["content"]
-                rules.extend(CSSParser(body).parse())
-            except:
-                continue
-        style(self.nodes, sorted(rules, key=cascade_priority))
+                load, stage, payload = self.load_results.get_nowait()
+            except queue.Empty:
+                break
+            # Result of a load that was replaced by a newer one
+            if load is not self.page_load: continue
+
+            if stage == "error":
+                print(f"Load error: {payload}")
+                self.page_load = None
+            else:
+                self.show(payload)
+                if stage == "done":
+                    self.page_load = None
+                    self.save_trace()
+
+        if self.page_load is not None:
+            self.window.after(LOAD_POLL, self.poll_load)
+
+    # With BROWSER_TRACE set, write the spans of the loads so far and print where the time went
+    def save_trace(self):
+        if not TRACE_PATH: return
+        TRACER.save(TRACE_PATH)
+        print(TRACER.summary())
+
+    # Layout and draw a DocumentLayout from style_layout
+    def show(self, document):
+        self.nodes = document.node
 
-        # Layout
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
+        # Layout, only what is visible for now
+        self.document = document
+        self.layout_visible()
         self.draw()
 
+    '''
+    Bring the canvas to scroll_val with as few Tk calls as possible
+    1. Move every existing item at once by the scroll difference
+    2. Delete the items that left the overscan band, in one call
+    3. Create only the commands that entered the band
+    '''
     def draw(self):
-        self.canvas.delete("all")
-        for cmd in self.display_list:
-            # Skip if above the screen (cuz if the bottom is above then is out of screen)
-            # Cuz scroll_val keeps increasing when scroll down
-            if cmd.bottom < self.scroll_val: continue
-            
-            # Skip if below the screen
-            # Equivalent with y - scroll_val > height
-            # On init, y/cmd.top that is below the screen is > 800
-            if cmd.top > self.scroll_val + HEIGHT: continue
+        with span("draw") as args:
+            args["created"] = self.draw_items()
+
+    def draw_items(self):
+        canvas = self.canvas
+        dy = self.drawn_scroll - self.scroll_val
+        if dy and self.items:
+            canvas.move("all", 0, dy)
+        self.drawn_scroll = self.scroll_val
+
+        top = self.scroll_val - OVERSCAN
+        bottom = self.scroll_val + self.height + OVERSCAN
+        wanted = self.display_index.query_indexes(top, bottom)
+
+        wanted_set = set(wanted)
+        leaving = [i for i in self.items if i not in wanted_set]
+        if leaving:
+            canvas.delete(*[self.items.pop(i) for i in leaving])
+
+        '''
+        New items are created on top of the stack, but must sit right below the
+        existing item that comes after them in the display list (e.g. a background
+        rect scrolled in from above goes under its text). They get a tag named after
+        that item so each group is lowered with one call.
+        '''
+        display_list = self.display_list
+        existing = sorted(self.items)
+        groups = set()
+        created = 0
+        for i in wanted:
+            if i in self.items: continue
+            created += 1
+            pos = bisect(existing, i)
+            tags = ()
+            if pos < len(existing):
+                tags = ("below{}".format(existing[pos]),)
+                groups.add(existing[pos])
+            self.items[i] = display_list.execute(i, self.scroll_val, canvas, get_font, tags)
 
-            cmd.execute(self.scroll_val, self.canvas)
+        for above in groups:
+            tag = "below{}".format(above)
+            canvas.tag_lower(tag, self.items[above])
+            canvas.dtag(tag)
+        return created
 
 if __name__ == "__main__":
     import sys
-    Browser().load(URL(sys.argv[1]))
+    # A display list saved with DisplayList.save is shown as it is, anything else is a url
+    if sys.argv[1].endswith(".bdl"):
+        Browser().show_display_list(DisplayList.load(sys.argv[1]))
+    else:
+        Browser().load(URL(sys.argv[1]))
     tkinter.mainloop()
\ No newline at end of file
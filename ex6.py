@@ -1,4 +1,9 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
 from ex1 import Element
+from util import span, pre_order, walk, DiskCache
 
 class CSSParser:
     def __init__(self, s):
@@ -113,6 +118,84 @@ class CSSParser:
                     break
         return rules
 
+# Hash of a stylesheet's text, how the caches tell stylesheets apart
+def stylesheet_key(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+'''
+Memo of parsed CSS, so the same stylesheet or style attribute is parsed once
+- Stylesheets are keyed by a hash of their text, style attributes by the text itself
+- Both tiers are LRUs of max_entries
+- With cache_dir, parsed stylesheets are also pickled to disk and survive restarts
+Returned rules/declarations are shared, never mutate them
+'''
+class StyleSheetCache:
+    def __init__(self, max_entries=256, max_declarations=4096, cache_dir=None):
+        self.max_entries = max_entries
+        self.max_declarations = max_declarations
+        self.disk = DiskCache(cache_dir)
+        self.sheets = OrderedDict()        # hash -> rules
+        self.declarations = OrderedDict()  # style attribute -> {property: value}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # Same as CSSParser(text).parse()
+    def parse(self, text):
+        key = stylesheet_key(text)
+        with self.lock:
+            rules = self.sheets.get(key)
+            if rules is not None:
+                self.sheets.move_to_end(key)
+                self.hits += 1
+                return rules
+
+        rules = self.disk.load(key)
+        if rules is None:
+            with span("css_parse", bytes=len(text)) as args:
+                rules = CSSParser(text).parse()
+                args["rules"] = len(rules)
+            self.disk.save(key, rules)
+            with self.lock:
+                self.misses += 1
+        else:
+            with self.lock:
+                self.hits += 1
+        self.remember(self.sheets, key, rules, self.max_entries)
+        return rules
+
+    # Same as CSSParser(text).body()
+    def body(self, text):
+        with self.lock:
+            pairs = self.declarations.get(text)
+            if pairs is not None:
+                self.declarations.move_to_end(text)
+                self.hits += 1
+                return pairs
+            self.misses += 1
+
+        pairs = CSSParser(text).body()
+        self.remember(self.declarations, text, pairs, self.max_declarations)
+        return pairs
+
+    def remember(self, entries, key, value, limit):
+        with self.lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            while len(entries) > limit:
+                entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "sheets": len(self.sheets),
+                "declarations": len(self.declarations),
+            }
+
+STYLESHEET_CACHE = StyleSheetCache()
+
 INHERITED_PROPERTIES = {
     "font-size": "16px",
     "font-style": "normal",
@@ -120,44 +203,102 @@ INHERITED_PROPERTIES = {
     "color": "black",
 }
 
-# Check if node has style attribute, the value is still string
-# Put the style in the node (node.style)
+# Style the whole tree, rules is the cascade sorted list or a RuleIndex built from it
 def style(node, rules):
-    node.style = {}
+    index = rules if isinstance(rules, RuleIndex) else RuleIndex(rules)
+    with span("style", rules=len(index.rules)):
+        for _ in styled(node, index):
+            pass
 
-    # Setting default style properties
-    for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property] = node.parent.style[property]
+'''
+Style the tree while walking it, yielding the walk's (node, entering) events
+A node is styled by the time (node, True) comes out, so a caller can build on it in
+the same walk (see ex2.style_layout)
+- inherited holds, per open node, what its children inherit
+- ancestors counts the tags of the open elements, kept up to date on the way down and up
+'''
+def styled(node, rules):
+    index = rules if isinstance(rules, RuleIndex) else RuleIndex(rules)
+    inherited = [INHERITED_PROPERTIES]
+    ancestors = {}
+    for node, entering in walk(node):
+        if entering:
+            inherited.append(style_node(node, index, inherited[-1], ancestors))
+            # Count this node as the ancestor of its children
+            if node.children and isinstance(node, Element):
+                ancestors[node.tag] = ancestors.get(node.tag, 0) + 1
         else:
-            node.style[property] = default_value
+            inherited.pop()
+            if node.children and isinstance(node, Element):
+                ancestors[node.tag] -= 1
+                if not ancestors[node.tag]: del ancestors[node.tag]
+        yield node, entering
+
+'''
+Check if node has style attribute, the value is still string
+Put the style in the node (node.style), children are left to style()
 
-    # For every rules in CSS file, check if the node match the rule
-    for selector, body in rules:
-        if not selector.matches(node): continue
-        for property, value in body.items():
-            node.style[property] = value
+Styles are copy-on-write: inherited is the parent's inherited properties, and
+a node that changes nothing gets that same dict instead of its own copy.
+Never mutate node.style in place, it may be shared with other nodes.
+
+ancestors counts the tags of the open elements above node
+Return what node's children inherit
+'''
+def style_node(node, index, inherited, ancestors):
+    # No rule or style attribute applies to text, it is styled like its parent
+    if not isinstance(node, Element):
+        node.style = inherited
+        return inherited
+
+    changes = {}
+
+    # Only the rules whose rightmost tag is this node's tag can match
+    for body in index.matching(node, ancestors):
+        changes.update(body)
 
     # Style attribute in element override
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
-        for property, value in pairs.items():
-            node.style[property] = value
+    if "style" in node.attributes:
+        changes.update(STYLESHEET_CACHE.body(node.attributes["style"]))
 
     # Handle styling with value of %, this needs to be handled since it's relative to it's parent
     # Convert from % to px
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-size"]
-        else:
-            parent_font_size = INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
-        parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
+    if changes.get("font-size", "").endswith("%"):
+        node_pct = float(changes["font-size"][:-1]) / 100
+        parent_px = float(inherited["font-size"][:-2])
+        changes["font-size"] = str(node_pct * parent_px) + "px"
+
+    # Only copy when something differs from what is inherited
+    if all(inherited.get(property) == value for property, value in changes.items()):
+        node.style = inherited
+        return inherited
+
+    node.style = {**inherited, **changes}
+    if not any(property in INHERITED_PROPERTIES for property in changes):
+        return inherited
+    elif all(property in INHERITED_PROPERTIES for property in node.style):
+        return node.style
+    else:
+        return {property: node.style[property] for property in INHERITED_PROPERTIES}
+
+'''
+Rules bucketed by the tag of their rightmost selector
+- A node only looks at the bucket of its own tag, instead of every rule
+- Buckets keep the order of the sorted rules, so the cascade stays the same
+- Descendant selectors are rejected early when an ancestor tag they need is not open
+'''
+class RuleIndex:
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_tag = {}
+        for selector, body in rules:
+            self.by_tag.setdefault(selector.key_tag(), []).append((selector, body))
 
-    # Do the same to the child
-    for child in node.children:
-        style(child, rules)
+    def matching(self, node, ancestors):
+        if not isinstance(node, Element): return
+        for selector, body in self.by_tag.get(node.tag, ()):
+            if selector.matches_fast(node, ancestors):
+                yield body
 
 # Wrap tag (e.g. p, div) to a class
 # TODO: check if the priority order is correct
@@ -169,12 +310,24 @@ class TagSelector:
     def matches(self, node):
         return isinstance(node, Element) and self.tag == node.tag
 
+    # Tag a node must have to match, used to bucket rules
+    def key_tag(self):
+        return self.tag
+
+    def ancestor_tags(self):
+        return {self.tag}
+
+    # node already has the right tag (it came from the bucket)
+    def matches_fast(self, node, ancestors):
+        return True
+
 class DescendantSelector:
     def __init__(self, ancestor, descendant):
         # These two are of type TagSelector
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority
+        self.required = frozenset(ancestor.ancestor_tags())
 
     # Check if current node match the tag
     # Then recursively going up checking ancestor with node.parent
@@ -185,11 +338,24 @@ class DescendantSelector:
             node = node.parent
         return False
 
+    def key_tag(self):
+        return self.descendant.key_tag()
+
+    # Every tag in the selector, any node matching it has them all as ancestors or itself
+    def ancestor_tags(self):
+        return self.ancestor.ancestor_tags() | self.descendant.ancestor_tags()
+
+    # Check the tags the ancestor part needs against the open ancestors first
+    # For "a b" that is the whole answer, longer chains still walk up to check the order
+    def matches_fast(self, node, ancestors):
+        for tag in self.required:
+            if tag not in ancestors: return False
+        if isinstance(self.ancestor, TagSelector): return True
+        return self.matches(node)
+
 # Generic helper function
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    list.extend(pre_order(tree))
     return list
 
 # for sorting css rule
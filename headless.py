@@ -0,0 +1,84 @@
+import unicodedata
+
+'''
+Pure python stand-in for tkinter.font.Font, so layout runs without a display
+- Advances are Helvetica's AFM widths (1000 units per em), italic shares them
+- Characters outside the table are half an em, wide (CJK) ones a full em
+- Tk sizes are points, at 96 dpi one point is 4/3 pixel
+'''
+
+REGULAR_ADVANCES = {
+    " ": 278, "!": 278, "\"": 355, "#": 556, "$": 556, "%": 889, "&": 667, "'": 191,
+    "(": 333, ")": 333, "*": 389, "+": 584, ",": 278, "-": 333, ".": 278, "/": 278,
+    "0": 556, "1": 556, "2": 556, "3": 556, "4": 556, "5": 556, "6": 556, "7": 556,
+    "8": 556, "9": 556, ":": 278, ";": 278, "<": 584, "=": 584, ">": 584, "?": 556,
+    "@": 1015, "A": 667, "B": 667, "C": 722, "D": 722, "E": 667, "F": 611, "G": 778,
+    "H": 722, "I": 278, "J": 500, "K": 667, "L": 556, "M": 833, "N": 722, "O": 778,
+    "P": 667, "Q": 778, "R": 722, "S": 667, "T": 611, "U": 722, "V": 667, "W": 944,
+    "X": 667, "Y": 667, "Z": 611, "[": 278, "\\": 278, "]": 278, "^": 469, "_": 556,
+    "`": 333, "a": 556, "b": 556, "c": 500, "d": 556, "e": 556, "f": 278, "g": 556,
+    "h": 556, "i": 222, "j": 222, "k": 500, "l": 222, "m": 833, "n": 556, "o": 556,
+    "p": 556, "q": 556, "r": 333, "s": 500, "t": 278, "u": 556, "v": 500, "w": 722,
+    "x": 500, "y": 500, "z": 500, "{": 334, "|": 260, "}": 334, "~": 584,
+}
+
+BOLD_ADVANCES = {
+    " ": 278, "!": 333, "\"": 474, "#": 556, "$": 556, "%": 889, "&": 722, "'": 238,
+    "(": 333, ")": 333, "*": 389, "+": 584, ",": 278, "-": 333, ".": 278, "/": 278,
+    "0": 556, "1": 556, "2": 556, "3": 556, "4": 556, "5": 556, "6": 556, "7": 556,
+    "8": 556, "9": 556, ":": 333, ";": 333, "<": 584, "=": 584, ">": 584, "?": 611,
+    "@": 975, "A": 722, "B": 722, "C": 722, "D": 722, "E": 667, "F": 611, "G": 778,
+    "H": 722, "I": 278, "J": 556, "K": 722, "L": 611, "M": 833, "N": 722, "O": 778,
+    "P": 667, "Q": 778, "R": 722, "S": 667, "T": 611, "U": 722, "V": 667, "W": 944,
+    "X": 667, "Y": 667, "Z": 611, "[": 333, "\\": 278, "]": 333, "^": 584, "_": 556,
+    "`": 333, "a": 556, "b": 611, "c": 556, "d": 611, "e": 556, "f": 333, "g": 611,
+    "h": 611, "i": 278, "j": 278, "k": 556, "l": 278, "m": 889, "n": 611, "o": 611,
+    "p": 611, "q": 611, "r": 389, "s": 556, "t": 333, "u": 611, "v": 556, "w": 778,
+    "x": 556, "y": 556, "z": 500, "{": 389, "|": 280, "}": 389, "~": 584,
+}
+
+DEFAULT_ADVANCE = 556
+WIDE_ADVANCE = 1000
+
+# Vertical metrics as a fraction of the pixel size (Arial's hhea table)
+ASCENT = 0.905
+DESCENT = 0.212
+
+PIXELS_PER_POINT = 96 / 72
+
+class HeadlessFont:
+    # Same keyword arguments as tkinter.font.Font
+    def __init__(self, size=12, weight="normal", slant="roman"):
+        self.size = size
+        self.weight = weight
+        self.slant = slant
+        self.key = (size, weight, slant)
+        self.advances = BOLD_ADVANCES if weight == "bold" else REGULAR_ADVANCES
+        # Tk takes negative sizes as pixels
+        self.pixels = -size if size < 0 else size * PIXELS_PER_POINT
+
+    def advance(self, c):
+        width = self.advances.get(c)
+        if width is None:
+            wide = unicodedata.east_asian_width(c) in ("W", "F")
+            width = WIDE_ADVANCE if wide else DEFAULT_ADVANCE
+        return width
+
+    def measure(self, text):
+        units = sum([self.advance(c) for c in text])
+        return round(units * self.pixels / 1000)
+
+    def metrics(self, *options):
+        ascent = round(self.pixels * ASCENT)
+        descent = round(self.pixels * DESCENT)
+        metrics = {
+            "ascent": ascent,
+            "descent": descent,
+            "linespace": ascent + descent,
+            "fixed": 0,
+        }
+        if options: return metrics[options[0]]
+        return metrics
+
+    def __repr__(self):
+        return "HeadlessFont" + repr(self.key)
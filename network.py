@@ -0,0 +1,459 @@
+import asyncio
+import queue
+import socket
+import ssl
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import CancelledError, wait
+
+from util import span
+
+READ_SIZE = 64 * 1024
+CANCEL_POLL = 0.05  # seconds between checks of a cancelled event while waiting on the loop
+
+'''
+Cached DNS answers, (host, port) -> addresses, for ttl seconds
+- Lookups for a name already being resolved wait for that lookup instead of starting another
+- Only used on the engine's event loop, so no lock
+'''
+class DNSCache:
+    def __init__(self, ttl=60, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (host, port) -> (expires, addresses), least recently used first
+        self.pending = {}             # (host, port) -> lookup in flight
+        self.hits = 0
+        self.misses = 0
+
+    async def resolve(self, host, port):
+        key = (host, port)
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+        lookup = self.pending.get(key)
+        if lookup is None:
+            self.misses += 1
+            lookup = self.pending[key] = asyncio.ensure_future(self.lookup(host, port))
+            lookup.add_done_callback(lambda done: self.done(key, done))
+        # A caller giving up (timeout, cancel) must not cancel the lookup for the others
+        return await asyncio.shield(lookup)
+
+    async def lookup(self, host, port):
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, family=socket.AF_INET,
+                                                             type=socket.SOCK_STREAM)
+        addresses = [info[4] for info in infos]
+        self.entries[(host, port)] = (time.monotonic() + self.ttl, addresses)
+        self.entries.move_to_end((host, port))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return addresses
+
+    def done(self, key, lookup):
+        self.pending.pop(key, None)
+        # Nobody may be waiting anymore, mark the error as seen
+        if not lookup.cancelled(): lookup.exception()
+
+    # The addresses didn't work, look them up again next time
+    def forget(self, host, port):
+        self.entries.pop((host, port), None)
+
+# Stream pair of one keep-alive socket
+class Connection:
+    def __init__(self, reader, writer, key):
+        self.reader = reader
+        self.writer = writer
+        self.key = key
+        self.last_used = time.monotonic()
+
+    # The loop keeps reading idle sockets, so a close by the server shows up as eof
+    def is_stale(self):
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+'''
+Keep-alive sockets keyed by (scheme, host, port), used on the engine's event loop
+- acquire() hands out an idle socket (hit) or opens a new one (miss)
+- release() puts it back if the response allows it, else closes it
+- At most max_per_host requests per key run at once, so at most that many sockets are open
+- Idle sockets older than idle_timeout or closed by the server are evicted
+'''
+class ConnectionPool:
+    def __init__(self, dns, max_per_host=6, idle_timeout=15):
+        self.dns = dns
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.idle = {}    # key -> [Connection], most recently used last
+        self.limits = {}  # key -> Semaphore of max_per_host
+        self.ssl_context = None
+        self.hits = 0
+        self.misses = 0
+        self.reconnects = 0
+
+    def limit(self, key):
+        if key not in self.limits:
+            self.limits[key] = asyncio.Semaphore(self.max_per_host)
+        return self.limits[key]
+
+    async def acquire(self, scheme, host, port, connect_timeout):
+        key = (scheme, host, port)
+        await self.limit(key).acquire()
+        try:
+            self.evict_idle()
+            idle = self.idle.get(key, [])
+            while idle:
+                conn = idle.pop()
+                if not conn.is_stale():
+                    self.hits += 1
+                    return conn, True
+                conn.close()
+
+            self.misses += 1
+            try:
+                reader, writer = await asyncio.wait_for(self.connect(scheme, host, port), connect_timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("Connect to {} timed out after {}s".format(host, connect_timeout))
+            return Connection(reader, writer, key), False
+        except BaseException:
+            self.limits[key].release()
+            raise
+
+    def release(self, conn, reusable):
+        if reusable and not conn.is_stale():
+            conn.last_used = time.monotonic()
+            self.idle.setdefault(conn.key, []).append(conn)
+        else:
+            conn.close()
+        self.limits[conn.key].release()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        for idle in self.idle.values():
+            for conn in [c for c in idle if now - c.last_used > self.idle_timeout]:
+                idle.remove(conn)
+                conn.close()
+
+    def close_all(self):
+        for idle in self.idle.values():
+            while idle:
+                idle.pop().close()
+
+    async def connect(self, scheme, host, port):
+        with span("dns", host=host):
+            addresses = await self.dns.resolve(host, port)
+
+        context = None
+        if scheme == "https":
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            context = self.ssl_context
+
+        # Try every address with a plain connection, then upgrade it to tls
+        error = OSError("No address for " + host)
+        connection = None
+        with span("connect", host=host):
+            for address in addresses:
+                try:
+                    connection = await asyncio.open_connection(address[0], address[1])
+                    break
+                except OSError as e:
+                    error = e
+        if connection is None:
+            self.dns.forget(host, port)
+            raise error
+
+        reader, writer = connection
+        if context is not None:
+            # StreamWriter.start_tls runs loop.start_tls and swaps the transport under the stream
+            with span("tls", host=host):
+                try:
+                    await writer.start_tls(context, server_hostname=host)
+                except BaseException:
+                    writer.close()
+                    raise
+        return reader, writer
+
+'''
+Read a response body as bytes off a keep-alive stream
+- Framing: chunked, Content-Length, or until the server closes
+- Content-Encoding gzip/deflate is undone per chunk with a zlib stream
+- complete is True once the body ended where the framing said it would,
+  only then is the socket safe to reuse
+read wraps every read, that's where the read timeout is applied
+'''
+class ResponseReader:
+    def __init__(self, reader, headers, read):
+        self.reader = reader
+        self.headers = headers
+        self.read = read
+        self.complete = False
+
+    async def exactly(self, size):
+        try:
+            return await self.read(self.reader.readexactly(size))
+        except asyncio.IncompleteReadError:
+            raise ValueError("Connection closed")
+
+    # Raw (still compressed) pieces of the body
+    async def raw_chunks(self):
+        transfer_encoding = self.headers.get("transfer-encoding", "").casefold()
+        if "chunked" in transfer_encoding:
+            while True:
+                line = await self.read(self.reader.readline())
+                if not line: raise ValueError("Connection closed")
+                size = int(line.split(b";", 1)[0].strip(), 16)
+                if size == 0: break
+                chunk = await self.exactly(size)
+                await self.read(self.reader.readline())  # CRLF after every chunk
+                yield chunk
+            # Skip trailers till the empty line
+            while await self.read(self.reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            self.complete = True
+
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+            while remaining > 0:
+                chunk = await self.read(self.reader.read(min(remaining, READ_SIZE)))
+                if not chunk: raise ValueError("Connection closed")
+                remaining -= len(chunk)
+                yield chunk
+            self.complete = True
+
+        else:
+            while True:
+                chunk = await self.read(self.reader.read(READ_SIZE))
+                if not chunk: break
+                yield chunk
+
+    # Decompressed pieces of the body
+    async def chunks(self):
+        encoding = self.headers.get("content-encoding", "identity").casefold()
+        if encoding in ("identity", ""):
+            async for chunk in self.raw_chunks():
+                yield chunk
+            return
+
+        if encoding in ("gzip", "x-gzip"):
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            decoder = None  # zlib wrapped or raw, decided on the first chunk
+        else:
+            raise ValueError("Unsupported content-encoding: " + encoding)
+
+        async for chunk in self.raw_chunks():
+            if decoder is None:
+                # Some servers send raw deflate without the zlib header
+                is_zlib = len(chunk) >= 2 and (chunk[0] & 0x0f) == 8 \
+                    and ((chunk[0] << 8) | chunk[1]) % 31 == 0
+                decoder = zlib.decompressobj(zlib.MAX_WBITS if is_zlib else -zlib.MAX_WBITS)
+            data = decoder.decompress(chunk)
+            if data: yield data
+        if decoder is not None:
+            data = decoder.flush()
+            if data: yield data
+
+# End of a streamed body
+END = object()
+
+'''
+HTTP/1.1 client running on one asyncio event loop, shared by every request
+- The loop runs on its own daemon thread, blocking callers (URL.request, fetch_all's
+  threads, the page load worker) hand it requests and wait for them
+- connect_timeout covers DNS, TCP and TLS, read_timeout any single read,
+  total_timeout the whole request including its body
+- Waiting callers can pass a threading.Event, setting it cancels the request
+- Timeouts raise TimeoutError, cancelled requests CancelledError
+'''
+class NetworkEngine:
+    def __init__(self, connect_timeout=10, read_timeout=10, total_timeout=30,
+                 dns_ttl=60, max_per_host=6, idle_timeout=15):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.dns = DNSCache(dns_ttl)
+        self.pool = ConnectionPool(self.dns, max_per_host, idle_timeout)
+        self.loop = None
+        self.lock = threading.Lock()
+
+    # The loop thread starts with the first request
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, daemon=True, name="network").start()
+        return self.loop
+
+    def close(self):
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is None: return
+        asyncio.run_coroutine_threadsafe(self.close_all(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    async def close_all(self):
+        self.pool.close_all()
+
+    # Run coroutine on the loop and wait for its result
+    def run(self, coroutine, cancelled=None):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.start())
+        while not wait([future], timeout=CANCEL_POLL if cancelled else None).done:
+            if cancelled.is_set():
+                future.cancel()
+                raise CancelledError()
+        return future.result()
+
+    # Not wait_for, a read or connect timeout inside must keep its own error
+    async def within_total(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        try:
+            done, _ = await asyncio.wait([task], timeout=self.total_timeout)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task in done: return task.result()
+        task.cancel()
+        raise TimeoutError("Request took over {}s".format(self.total_timeout))
+
+    async def read(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.read_timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("Read timed out after {}s".format(self.read_timeout))
+
+    '''
+    Send one GET, the body is read in full
+    Return status, headers and the body bytes (already decompressed)
+    '''
+    def fetch(self, scheme, host, port, path, headers={}, cancelled=None):
+        return self.run(self.within_total(self.fetch_async(scheme, host, port, path, headers)), cancelled)
+
+    async def fetch_async(self, scheme, host, port, path, headers):
+        conn, status, res_headers, reusable = await self.open_response(scheme, host, port, path, headers)
+        with span("body") as args:
+            content = b"".join([chunk async for chunk in self.body_chunks(conn, status, res_headers, reusable)])
+            args["bytes"] = len(content)
+        return status, res_headers, content
+
+    '''
+    Send one GET and yield (status, headers) first, then the body pieces as they arrive
+    Closing the generator early cancels the request
+    '''
+    def stream(self, scheme, host, port, path, headers={}, cancelled=None):
+        items = queue.Queue()
+        pump = self.within_total(self.pump(scheme, host, port, path, headers, items))
+        future = asyncio.run_coroutine_threadsafe(pump, self.start())
+        try:
+            while True:
+                try:
+                    item = items.get(timeout=CANCEL_POLL)
+                except queue.Empty:
+                    if cancelled is not None and cancelled.is_set(): raise CancelledError()
+                    if future.done() and future.exception() is not None: raise future.exception()
+                    continue
+                if item is END: break
+                if isinstance(item, BaseException): raise item
+                yield item
+        finally:
+            future.cancel()
+
+    async def pump(self, scheme, host, port, path, headers, items):
+        conn, status, res_headers, reusable = await self.open_response(scheme, host, port, path, headers)
+        items.put((status, res_headers))
+        try:
+            async for chunk in self.body_chunks(conn, status, res_headers, reusable):
+                items.put(chunk)
+        except Exception as e:
+            items.put(e)
+            return
+        items.put(END)
+
+    # Send the request and read status line and headers, the body is left unread
+    # Return the connection with the status, headers and whether it can be reused
+    async def open_response(self, scheme, host, port, path, headers):
+        while True:
+            conn, reused = await self.pool.acquire(scheme, host, port, self.connect_timeout)
+            try:
+                # Time till the status line and headers are in
+                with span("first_byte", reused=reused):
+                    conn.writer.write(request_bytes(host, path, headers))
+                    await self.read(conn.writer.drain())
+                    status, res_headers, reusable = await self.read_head(conn.reader)
+            except (OSError, ValueError) as e:
+                self.pool.release(conn, reusable=False)
+                # A reused socket may have been closed by the server meanwhile, retry on a new one
+                if not reused or isinstance(e, TimeoutError): raise
+                self.pool.reconnects += 1
+                continue
+            except BaseException:
+                self.pool.release(conn, reusable=False)
+                raise
+            return conn, status, res_headers, reusable
+
+    async def read_head(self, reader):
+        # split response
+        statusline = (await self.read(reader.readline())).decode("latin-1")
+        if not statusline: raise ValueError("Connection closed")
+        version, status, explanation = statusline.split(" ", 2)
+        res_headers = {}
+        while True:
+            line = (await self.read(reader.readline())).decode("latin-1")
+            if line in ("\r\n", "\n", ""): break
+            header, value = line.split(":", 1)
+            res_headers[header.casefold()] = value.strip()
+
+        # Keep-alive is the default from HTTP/1.1 unless the server says otherwise
+        connection = res_headers.get("connection", "").casefold()
+        if version == "HTTP/1.0":
+            reusable = connection == "keep-alive"
+        else:
+            reusable = connection != "close"
+        return int(status), res_headers, reusable
+
+    # Yield decompressed body pieces as they arrive
+    # The socket goes back to the pool after the last one, or is closed if we stop early
+    async def body_chunks(self, conn, status, res_headers, reusable):
+        complete = False
+        try:
+            if status in (204, 304) or 100 <= status < 200:
+                complete = True
+            else:
+                reader = ResponseReader(conn.reader, res_headers, self.read)
+                async for chunk in reader.chunks():
+                    yield chunk
+                complete = reader.complete
+        finally:
+            self.pool.release(conn, reusable and complete)
+
+    def stats(self):
+        return self.run(self.snapshot())
+
+    async def snapshot(self):
+        return {
+            "hits": self.pool.hits,
+            "misses": self.pool.misses,
+            "reconnects": self.pool.reconnects,
+            "idle": sum(len(idle) for idle in self.pool.idle.values()),
+            "dns_hits": self.dns.hits,
+            "dns_misses": self.dns.misses,
+        }
+
+def request_bytes(host, path, headers):
+    # form request
+    req = "GET {} HTTP/1.1\r\n".format(path)
+    req += "Host: {}\r\n".format(host)
+    req += "Connection: {}\r\n".format("keep-alive")
+    req += "User-Agent: {}\r\n".format("mozilla")
+    req += "Accept-Encoding: {}\r\n".format("gzip, deflate")
+    for header, value in headers.items():
+        req += "{}: {}\r\n".format(header, value)
+    req += "\r\n"
+    return req.encode("utf-8")
+
+ENGINE = NetworkEngine()
@@ -1,4 +1,11 @@
+import hashlib
+import json
+import os
+import pickle
+import threading
 import time
+from collections import deque
+from contextlib import contextmanager
 from time import perf_counter
 
 def elapsed_ms(func, *args, **kwargs):
@@ -7,4 +14,189 @@ def elapsed_ms(func, *args, **kwargs):
     end_time = perf_counter()
 
     elapsed_time = (end_time - start_time) * 1000
-    return elapsed_time, res
\ No newline at end of file
+    return elapsed_time, res
+
+'''
+Tree traversals with an explicit stack instead of recursion
+- Any depth works, Python's recursion limit (about 1000) never comes into it
+- Work on anything with a children list (HTML nodes, layout objects)
+- Children lists must not change while a traversal is walking them
+'''
+# Parents before children, in document order
+def pre_order(root):
+    yield root
+    # One iterator per open node, leaves never touch the stack
+    stack = [iter(root.children)]
+    push, pop = stack.append, stack.pop
+    while stack:
+        for node in stack[-1]:
+            yield node
+            if node.children:
+                push(iter(node.children))
+                break
+        else:
+            pop()
+
+# Same as pre_order, but yields (node, depth) with depth 0 for root
+def pre_order_depth(root):
+    yield root, 0
+    stack = [iter(root.children)]
+    while stack:
+        for node in stack[-1]:
+            yield node, len(stack)
+            if node.children:
+                stack.append(iter(node.children))
+                break
+        else:
+            stack.pop()
+
+# Children before parents, siblings in document order
+def post_order(root):
+    for node, entering in walk(root):
+        if not entering: yield node
+
+'''
+Yield (node, True) on the way down and (node, False) on the way back up, once the
+node's children are done. Good for passes that keep state per open ancestor.
+prune(node) is asked after the caller handled (node, True), True skips the node's children
+'''
+def walk(root, prune=None):
+    # (open node, iterator over its children), the bottom entry only holds root itself
+    stack = [(root, iter((root,)))]
+    push, pop = stack.append, stack.pop
+    while stack:
+        parent, children = stack[-1]
+        for node in children:
+            yield node, True
+            if node.children and not (prune and prune(node)):
+                push((node, iter(node.children)))
+                break
+            yield node, False
+        else:
+            pop()
+            if stack: yield parent, False
+
+'''
+Spans of where page load time goes, exportable as Chrome trace-event JSON
+(open in chrome://tracing or ui.perfetto.dev) or as a one line summary
+- span() is a context manager, the dict it yields can be filled with counts (nodes, rules, ...)
+- Off unless enabled, then span() only yields a throwaway dict
+- Keeps the last max_events spans
+'''
+class Tracer:
+    def __init__(self, enabled=False, max_events=100_000):
+        self.enabled = enabled
+        self.events = deque(maxlen=max_events)
+        self.origin = perf_counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **args):
+        if not self.enabled:
+            yield args
+            return
+        start = perf_counter()
+        try:
+            yield args
+        finally:
+            end = perf_counter()
+            self.add(name, start, end, args)
+
+    def add(self, name, start, end, args):
+        with self.lock:
+            self.events.append({
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            })
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+    def chrome_trace(self):
+        with self.lock:
+            events = list(self.events)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f, default=str)
+
+    # e.g. "request 2x 120.4ms | parse 15.2ms nodes=1203 | style 8.1ms"
+    def summary(self):
+        totals = {}
+        with self.lock:
+            for event in self.events:
+                total = totals.setdefault(event["name"], {"count": 0, "ms": 0, "args": {}})
+                total["count"] += 1
+                total["ms"] += event["dur"] / 1000
+                for key, value in event["args"].items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        total["args"][key] = total["args"].get(key, 0) + value
+
+        parts = []
+        for name, total in totals.items():
+            part = name
+            if total["count"] > 1: part += " {}x".format(total["count"])
+            part += " {:.1f}ms".format(total["ms"])
+            for key, value in total["args"].items():
+                part += " {}={}".format(key, value)
+            parts.append(part)
+        return " | ".join(parts)
+
+# Set BROWSER_TRACE to a file path to record spans and write them there after each page load
+TRACE_PATH = os.environ.get("BROWSER_TRACE")
+TRACER = Tracer(enabled=bool(TRACE_PATH))
+
+def span(name, **args):
+    return TRACER.span(name, **args)
+
+# Bump when what the caches pickle changes shape, files of another version are ignored
+DISK_CACHE_VERSION = 1
+
+'''
+Disk tier shared by the response and stylesheet caches, one pickle file per key
+- Files are named by a hash of the key, the key is stored too so a clash reads as a miss
+- Without a directory nothing is stored and every load misses
+- A file that can't be read, or has another DISK_CACHE_VERSION, is a miss
+'''
+class DiskCache:
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        if not self.directory: return None
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def load(self, key):
+        path = self.path(key)
+        if not path or not os.path.exists(path): return None
+        try:
+            with open(path, "rb") as f:
+                version, stored_key, value = pickle.load(f)
+        except Exception:
+            return None
+        if version != DISK_CACHE_VERSION or stored_key != key: return None
+        return value
+
+    def save(self, key, value):
+        path = self.path(key)
+        if not path: return
+        # Write then rename so a crash never leaves half an entry behind
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump((DISK_CACHE_VERSION, key, value), f)
+        os.replace(tmp, path)
+
+    def remove(self, key):
+        path = self.path(key)
+        if path and os.path.exists(path):
+            os.remove(path)